@@ -1,18 +1,48 @@
-from .annotate import (
-    experiment_model,
-    project_model,
-    tools,
-    check_env,
-    project_text,
-    exp_text,
-    summarize,
-    jsonOut,
-    sampleExps,
-    bool_check,
-    tagExps,
-    setControl,
-    annotate
-)
+import sys
+import types
+import importlib
 
-from .fetch import fetch
-from .validate import bool_check
\ No newline at end of file
+# public names and the submodule they come from, submodules are only imported on first use
+# so `import llomics` doesn't pull in pandas/openai/pydantic/biopython
+_exports = {'experiment_model': 'annotate',
+            'project_model': 'annotate',
+            'tools': 'annotate',
+            'check_env': 'annotate',
+            'project_text': 'annotate',
+            'exp_text': 'annotate',
+            'summarize': 'annotate',
+            'consensus_summary': 'annotate',
+            'jsonOut': 'annotate',
+            'estimate': 'annotate',
+            'sampleExps': 'annotate',
+            'annotate_project': 'annotate',
+            'annotate_iter': 'annotate',
+            'annotate': 'annotate',
+            'tagExps': 'tag',
+            'setControl': 'tag',
+            'ResponseCache': 'cache',
+            'Checkpoint': 'checkpoint',
+            'MetaStore': 'store',
+            'fetch': 'fetch',
+            'bool_check': 'validate',
+            'project_checks': 'validate'}
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f'.{_exports[name]}', __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
+
+class _Package(types.ModuleType):
+    def __setattr__(self, name, value):
+        # importing the annotate/fetch submodules would set them as package attributes,
+        # llomics.annotate and llomics.fetch stay the functions of the same name
+        if isinstance(value, types.ModuleType) and _exports.get(name) == name:
+            return
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _Package
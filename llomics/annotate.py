@@ -1,12 +1,30 @@
 import os
 import json
+import time
 import random
+import queue
+import threading
+import importlib
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-import tiktoken
-from openai import OpenAI
-from pydantic import BaseModel, Field
+from collections import Counter
+from pydantic import BaseModel, Field, ValidationError
 from typing import Literal, List, Optional
-import llomics.fetch as fetch
+# the package attribute llomics.fetch is the fetch function, get the module itself
+fetch = importlib.import_module('llomics.fetch')
+from llomics.limits import RateLimiter, retry
+from llomics.cache import ResponseCache, CacheMiss
+from llomics.store import MetaStore
+from llomics.checkpoint import Checkpoint
+from llomics.rules import classify
+from llomics.replicates import replicate_groups, fan_out
+from llomics.validate import cascade_check
+from llomics.tag import finalize, write_output
+# annotate.bool_check, annotate.tagExps and annotate.setControl were defined here, kept importable from here
+from llomics.validate import bool_check  # noqa: F401
+from llomics.tag import tagExps, setControl  # noqa: F401
+from llomics.columnar import read_table, is_metadata
+from llomics.metrics import metrics, count_tokens, truncate_tokens, request_tokens, dollars, cost as token_cost
 
 class experiment_model(BaseModel):
     """Fill in the metatdata for a ChIP-seq experiment, let's think this through step by step."""
@@ -34,6 +52,10 @@ class project_model(BaseModel):
     project_id: str 
     project_title: str
     experimentMeta: List[experiment_model]
+
+class batch_model(BaseModel):
+    """Fill in the metadata for each of the ChIP-seq experiments, one entry per experiment ID, let's think this through step by step."""
+    experimentMeta: List[experiment_model] = project_model.model_fields['experimentMeta']
     
 tools = [
     {
@@ -43,39 +65,198 @@ tools = [
     }
 ]
 
+batch_tools = [
+    {
+        "name": "json_batch_output",
+        "description": "Extract metadata from summary for json output, one entry per experiment.",
+        "parameters": batch_model.model_json_schema()
+    }
+]
+
+# OpenAI client, built by get_client() on the first request
+client = None
+client_lock = threading.Lock()
+# shared request governors, set with set_limits()
+request_limiter = None
+token_limiter = None
+max_retries = 5
+# optional persistent response cache, set with set_cache()
+cache = None
+# prompt rendering, set with set_prompts()
+compact_prompts = False
+protocol_tokens = 400
+
 # function to check for necessary environment variables
 def check_env():
 
     if os.environ.get('OPENAI_API_KEY') is None:
         raise ValueError("OPENAI_API_KEY environment variable must be set")
+
+def get_client():
+    """
+    the shared OpenAI client, openai is only imported and the client built when the first request needs it
+    """
+    global client
+    with client_lock:
+        if client is None:
+            from openai import OpenAI
+            check_env()
+            # OPENAI_BASE_URL can point at any OpenAI compatible server (eg. a local mock)
+            # retries are handled by chat() so the client's own retry loop is disabled
+            client = OpenAI(api_key = os.environ.get('OPENAI_API_KEY'),
+                            base_url = os.environ.get('OPENAI_BASE_URL'),
+                            max_retries = 0)
+    return client
+
+def set_limits(rpm = None, tpm = None, retries = 5):
+    """
+    Configure the requests/tokens per minute governor and retry count shared by all chat requests.
+    """
+    global request_limiter, token_limiter, max_retries
+    request_limiter = RateLimiter(rpm) if rpm else None
+    token_limiter = RateLimiter(tpm) if tpm else None
+    max_retries = retries
+
+def set_cache(path = None, read_only = False, max_entries = None, max_age = None):
+    """
+    Use an on-disk response cache for all chat requests, `path` can also be a ResponseCache, None disables caching.
+    """
+    global cache
+    if path is None or isinstance(path, ResponseCache):
+        cache = path
     else:
-        global client
-        client = OpenAI(api_key = os.environ.get('OPENAI_API_KEY')) 
+        cache = ResponseCache(path, max_entries = max_entries, max_age = max_age, read_only = read_only)
+    return cache
+
+def set_prompts(compact = False, max_protocol_tokens = 400):
+    """
+    Use the compact rendering of project/experiment metadata in every prompt (see exp_text),
+    compact prompts also cut the project protocol to `max_protocol_tokens` tokens.
+    Returns the previous (compact, max_protocol_tokens) so a run can restore them.
+    """
+    global compact_prompts, protocol_tokens
+    previous = (compact_prompts, protocol_tokens)
+    compact_prompts = compact
+    protocol_tokens = max_protocol_tokens
+    return previous
+
+def _retryable(exc):
+    # retry rate limits, server errors and dropped connections, anything else is a real error
+    import openai
+    if isinstance(exc, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code >= 500
+
+def _retry_after(exc):
+    response = getattr(exc, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+def chat(kind = 'chat', **request):
+    """
+    Send a chat completion request through the shared rate limits, retrying with backoff on 429/5xx.
+    Identical requests are answered from the response cache when one is set.
+    Tokens and latency are recorded in metrics under `kind`.
+    """
+    start = time.perf_counter()
+    if cache is not None:
+        from openai.types.chat import ChatCompletion
+        key = cache.key(request)
+        cached = cache.get(key)
+        if cached is not None:
+            response = ChatCompletion.model_validate_json(cached)
+            metrics.record_call(kind, request['model'], response, time.perf_counter() - start, cached = True)
+            return response
+        if cache.read_only:
+            raise CacheMiss(f"request for model {request['model']} is not in read-only cache {cache.path}")
+
+    def send():
+        if request_limiter is not None:
+            request_limiter.acquire()
+        if token_limiter is not None:
+            token_limiter.acquire(request_tokens(request))
+        return get_client().chat.completions.create(**request)
+
+    response = retry(send, 
+                     retries = max_retries, 
+                     retryable = _retryable, 
+                     retry_after = _retry_after)
+    metrics.record_call(kind, request['model'], response, time.perf_counter() - start)
+
+    if cache is not None:
+        cache.put(key, response.model_dump_json())
+
+    return response
 
 def check_tokens(prompt, model):
-    tokenizer = tiktoken.encoding_for_model(model)
-    tokens = len(tokenizer.encode(prompt))
-    if model == 'gpt-4o':
-        cost = (tokens/1000000)*5
-    elif model == 'gpt-4o-mini':
-        cost = (tokens/1000000)*0.15 
-    else:
+    tokens = count_tokens(prompt, model)
+    cost = token_cost(model, tokens)
+    if cost is None:
         cost = 'unable to calculate cost'
     
     return cost
 
 # utility functions to convert project and experiment metadat to a string object for prompting
-def project_text(prjMeta):
+def project_text(prjMeta, compact = None):
+    compact = compact_prompts if compact is None else compact
     project_title = prjMeta['project_title'].iloc[0]
     project_id = prjMeta['project_id'].iloc[0]
     project_abstract = prjMeta['abstract'].iloc[0]
     project_protocol = prjMeta['protocol'].iloc[0]
+    if compact and protocol_tokens is not None:
+        project_protocol = truncate_tokens(str(project_protocol), protocol_tokens)
 
     text = f"Project ID: {project_id}\nProject Title: '{project_title}'\nProject Abstract:\n{project_abstract}\nProject Protocol:\n{project_protocol}\n"
 
     return text
 
-def exp_text(expMeta):
+def exp_columns(meta):
+    """
+    the experiment columns used in prompts, with the attribute pairs when the table has them (for compact prompts)
+    """
+    columns = ['project_id','experiment_id', 'title', 'attributes', 'attribute_pairs']
+    return meta[[column for column in columns if column in meta]]
+
+def exp_table(expMeta):
+    """
+    Compact rendering of several experiments: attributes with the same value for every experiment are listed once,
+    then one line per experiment with its title and the values of the remaining attribute keys.
+    """
+    if 'attribute_pairs' in expMeta:
+        attributes = []
+        for pairs in expMeta['attribute_pairs']:
+            values = {}
+            for key, value in pairs:
+                values[key] = f'{values[key]}; {value}' if key in values else value
+            attributes.append(values)
+    else:
+        attributes = [{'attributes': value} for value in expMeta['attributes']]
+
+    keys = list(dict.fromkeys(key for values in attributes for key in values))
+    shared = {key: attributes[0][key] for key in keys if all(values.get(key) == attributes[0].get(key) for values in attributes)}
+    columns = [key for key in keys if key not in shared]
+
+    lines = []
+    if shared:
+        lines.append('Attributes shared by every experiment: ' + '; '.join(f'{key} : {value}' for key, value in shared.items()))
+    lines.append('Experiment ID | Experiment Title | ' + ' | '.join(columns))
+    for experiment_id, title, values in zip(expMeta['experiment_id'], expMeta['title'], attributes):
+        lines.append(f'{experiment_id} | {title} | ' + ' | '.join(values.get(key, '') for key in columns))
+
+    return '\n'.join(lines) + '\n'
+
+def exp_text(expMeta, compact = None):
+    """
+    experiment metadata for a prompt, one block per experiment or the compact exp_table (for more than one experiment)
+    """
+    compact = compact_prompts if compact is None else compact
+    if compact and len(expMeta) > 1:
+        return exp_table(expMeta)
+
     experiments = []
     for index, row in expMeta.iterrows():
         experiment_id = row['experiment_id']
@@ -86,12 +267,8 @@ def exp_text(expMeta):
 
     return '\n'.join(experiments)
 
-def summarize(model, 
-              prjMeta, 
-              expMeta):
-
-    system_prompt = "You are an assistant with domain expertise in yeast genetics and molecular biology, you are skilled in analyzing and summarizing metadata from high-throughput sequencing experiments."
-    summary_prompt = """Analyze the metadata for this ChIP-seq project and the experiments in the project.
+system_prompt = "You are an assistant with domain expertise in yeast genetics and molecular biology, you are skilled in analyzing and summarizing metadata from high-throughput sequencing experiments."
+summary_prompt = """Analyze the metadata for this ChIP-seq project and the experiments in the project.
 Briefly summarize the main goal of the project. What is the project testing? What are the different experimental conditions?
 Using the project **abstract**, project **protocol**, and the experiment **titles** and **attributes** answer the following questions. Let's think these through step by step.
 - What key words indicate if there are experiments with gene mutations in the project? Epitope tags should not be considered mutations. Some projects use cell lines or strains with common baseline genetic mutations or deletions that should be ignored, only mutations or deletions that are relevant to the project goal should be listed. 
@@ -109,16 +286,58 @@ Using the project **abstract**, project **protocol**, and the experiment **title
 - What key words indicate any small molecules being used in the project to induce stress or protein depletion in specific experiments?
 Your responses should be designed to be used by an LLM assistant tasked with classifying and generated structured metadata for each experiment in the project.
 """
+
+def prompt_savings(prjMeta, expMeta, model, batch_size = 1):
+    """
+    tokens of the metadata in a project's summarize and jsonOut prompts, in the verbose and in the compact format
+    """
+    tokens = {}
+    for compact in [False, True]:
+        n = count_tokens(project_text(prjMeta, compact) + exp_text(expMeta, compact), model)
+        for i in range(0, len(expMeta), batch_size):
+            n += count_tokens(exp_text(expMeta.iloc[i:i + batch_size], compact), model)
+        tokens['compact' if compact else 'verbose'] = n
+    return tokens
+
+def summary_request(model,
+                    prjMeta,
+                    expMeta,
+                    part = None,
+                    n = 1):
+    """
+    chat completion request summarizing a project, `part` = (i, n) for a request covering only the i-th of n chunks of its experiments.
+    `n` > 1 samples that many summaries in the one request.
+    """
     project = project_text(prjMeta)
     experiment = exp_text(expMeta)
 
     prompt = f"Here is study-level metadata for a series of ChIP-seq experiments in yeast:\n{project}\nHere is the NCBI metadata for all of the experiments included in this project:\n{experiment}\n{summary_prompt}"
+    if part is not None:
+        prompt = prompt.replace('for all of the experiments included in this project', f'for part {part[0]} of {part[1]} of the experiments included in this project, the other parts are summarized separately')
+
+    request = dict(
+        model = model,
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.1)
+    if n > 1:
+        request['n'] = n
 
-    # check the token count
-#    cost = check_tokens(prompt, model)
-#    print(f'Summarization will cost ~${cost}')
+    return request
 
-    response = client.chat.completions.create(
+def reduce_request(model,
+                   prjMeta,
+                   summaries):
+    """
+    chat completion request merging summaries of parts of a project into one project summary
+    """
+    project = project_text(prjMeta)
+    parts = '\n\n'.join(f'Summary of part {i + 1} of {len(summaries)}:\n{summary}' for i, summary in enumerate(summaries))
+    prompt = f"Here is study-level metadata for a series of ChIP-seq experiments in yeast:\n{project}\nThe project has too many experiments for one request, so its experiments were split into {len(summaries)} parts that were summarized separately:\n\n{parts}\n\nMerge these into a single summary of the whole project, combining the key words found in every part.\n{summary_prompt}"
+
+    request = dict(
         model = model,
         messages = [
             {"role": "system", "content": system_prompt},
@@ -126,32 +345,237 @@ Your responses should be designed to be used by an LLM assistant tasked with cla
         ],
         temperature=0.1)
 
+    return request
+
+def consensus_request(model,
+                      prjMeta,
+                      summaries):
+    """
+    chat completion request distilling several summaries of the same project into one consensus summary
+    """
+    project = project_text(prjMeta)
+    samples = '\n\n'.join(f'Summary {i + 1} of {len(summaries)}:\n{summary}' for i, summary in enumerate(summaries))
+    prompt = f"Here is study-level metadata for a series of ChIP-seq experiments in yeast:\n{project}\nHere are {len(summaries)} summaries generated by an llm of this project using the whole project metadata:\n\n{samples}\n\nExamine these summaries for consensus and write a single summary of the project. Keep the key words that the summaries agree on, and for key words they disagree on keep the one best supported by the metadata.\n{summary_prompt}"
+
+    request = dict(
+        model = model,
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.1)
+
+    return request
+
+def chunk_experiments(model, prjMeta, expMeta, max_tokens):
+    """
+    split the experiments into chunks whose summary request stays under `max_tokens` prompt tokens
+    """
+    budget = max_tokens - request_tokens(summary_request(model, prjMeta, expMeta.iloc[:0], part = (1, 1)))
+    if budget <= 0:
+        raise ValueError(f"max_tokens = {max_tokens} doesn't leave room for any experiments next to the project metadata")
+
+    chunks = []
+    start = 0
+    used = 0
+    # exp_text joins experiments with a blank line, count each experiment with its separator (+1 for tokens merged across the join)
+    sizes = [count_tokens(exp_text(expMeta.iloc[i:i + 1]) + '\n', model) + 1 for i in range(len(expMeta))]
+    for i, size in enumerate(sizes):
+        if used + size > budget and i > start:
+            chunks.append(expMeta.iloc[start:i])
+            start, used = i, 0
+        used += size
+    chunks.append(expMeta.iloc[start:])
+
+    return chunks
+
+def reduce_summaries(model, prjMeta, summaries, max_tokens = None):
+    """
+    merge chunk summaries with reduce requests, in a tree if they don't fit in one request
+    """
+    request = reduce_request(model, prjMeta, summaries)
+    if len(summaries) > 2 and max_tokens is not None and request_tokens(request) > max_tokens:
+        half = (len(summaries) + 1) // 2
+        summaries = [reduce_summaries(model, prjMeta, summaries[:half], max_tokens).choices[0].message.content,
+                     reduce_summaries(model, prjMeta, summaries[half:], max_tokens).choices[0].message.content]
+        request = reduce_request(model, prjMeta, summaries)
+
+    return chat(kind = 'reduce', **request)
+
+def summarize(model, 
+              prjMeta, 
+              expMeta,
+              max_tokens = None,
+              workers = 1,
+              n = 1):
+    """
+    Summarize a project in one request, or map-reduce it when the request is over `max_tokens` prompt tokens:
+    the experiments are split into chunks that fit, the chunks are summarized concurrently and the
+    chunk summaries are merged by a reduce request.
+    `n` > 1 samples n summaries, returned as the choices of the response. A single request asks for all n,
+    a map-reduce samples n summaries of every chunk and reduces the i-th of each chunk into the i-th summary.
+    """
+    request = summary_request(model, prjMeta, expMeta, n = n)
+    if max_tokens is None or request_tokens(request) <= max_tokens:
+        return chat(kind = 'summarize', **request)
+
+    chunks = chunk_experiments(model, prjMeta, expMeta, max_tokens)
+    print(f'summarizing {len(expMeta)} experiments in {len(chunks)} chunks')
+
+    def summarize_chunk(i):
+        response = chat(kind = 'summarize', **summary_request(model, prjMeta, chunks[i], part = (i + 1, len(chunks)), n = n))
+        return [choice.message.content for choice in response.choices]
+
+    with ThreadPoolExecutor(max_workers = max(1, workers)) as pool:
+        summaries = list(pool.map(summarize_chunk, range(len(chunks))))
+        if n == 1:
+            return reduce_summaries(model, prjMeta, [chunk[0] for chunk in summaries], max_tokens)
+        reduced = list(pool.map(lambda i: reduce_summaries(model, prjMeta, [chunk[i % len(chunk)] for chunk in summaries], max_tokens), range(n)))
+
+    # one response with the n reduced summaries as its choices
+    response = reduced[0].model_copy(deep = True)
+    response.choices = [choice.model_copy(update = {'index': i}) for i, choice in enumerate(r.choices[0] for r in reduced)]
     return response
 
-def jsonOut(model,
-            responses_text, 
-            expMeta,
-            summary_reps):
+def consensus(model,
+              prjMeta,
+              summaries):
+    """
+    distill several summaries of a project into one consensus summary (a single request)
+    """
+    return chat(kind = 'consensus', **consensus_request(model, prjMeta, summaries))
+
+def consensus_summary(model,
+                      prjMeta,
+                      expMeta,
+                      summary_reps = 1,
+                      max_tokens = None,
+                      workers = 1):
+    """
+    the summary the jsonOut prompts of a project use, returns (summary, sampled summaries).
+    With `summary_reps` > 1 the summaries are sampled together (the `n` parameter) and distilled into one
+    consensus summary, so every jsonOut prompt carries one summary instead of `summary_reps` of them.
+    """
+    response = summarize(model, prjMeta, expMeta, max_tokens = max_tokens, workers = workers, n = summary_reps)
+    samples = [choice.message.content for choice in response.choices]
+    if len(samples) == 1:
+        return samples[0], samples
+    return consensus(model, prjMeta, samples).choices[0].message.content, samples
+
+def json_request(model,
+                 responses_text,
+                 expMeta,
+                 summary_reps,
+                 batch = False):
+    """
+    chat completion request extracting structured metadata for one (or a batch of) experiments
+    """
 
-    system_prompt = "You are an assistant with domain expertise in yeast genetics and molecular biology, you are skilled in analyzing and summarizing metadata from high-throughput sequencing experiments."
     exptext = exp_text(expMeta)
     if summary_reps == 1:
         prompt = f"Here is a summary of a ChIP-seq project that was made using the whole project metadata:\n\n{responses_text}\n\nExtract details about the following experiment and use the **json_output** function to generate a structured output. Let's think this through step by step:\n\n{exptext}\n\n " # 24.03.31 changed method A3
     elif summary_reps > 1:
-        prompt = f"Here are {summary_reps} summaries generated by an llm of the same ChIP-seq project in yeast using the whole project metadata:\n\n{responses_text}\n\nExamine these summaries for consensus and extract details about the following experiment and use the **json_output** function to generate a structured output. Let's think this through step by step:\n\n{exptext}\n\n "
+        # the summaries are distilled into one consensus summary by consensus_summary
+        prompt = f"Here is a consensus summary of a ChIP-seq project in yeast, distilled from {summary_reps} summaries generated by an llm using the whole project metadata:\n\n{responses_text}\n\nExtract details about the following experiment and use the **json_output** function to generate a structured output. Let's think this through step by step:\n\n{exptext}\n\n "
 
-    response = client.chat.completions.create(
+    function = 'json_output'
+    if batch:
+        # several experiments per request, the summary is only sent once for the whole batch
+        prompt = prompt.replace('about the following experiment and use the **json_output** function',
+                                'about each of the following experiments and use the **json_batch_output** function, with exactly one entry per Experiment ID,')
+        function = 'json_batch_output'
+
+    request = dict(
         model = model,
         messages = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": prompt}
         ],
-        functions = tools,
+        functions = batch_tools if batch else tools,
         temperature=0.1,
-        function_call = {"name": "json_output"})
+        function_call = {"name": function})
+
+    return request
+
+def jsonOut(model,
+            responses_text, 
+            expMeta,
+            summary_reps,
+            batch = False):
+
+    response = chat(kind = 'jsonOut', **json_request(model, responses_text, expMeta, summary_reps, batch))
 
     return response
 
+def reduce_estimate(model, prjMeta, count, summary_len, max_tokens = None):
+    """
+    (requests, prompt tokens, completion tokens) of reduce_summaries merging `count` chunk summaries
+    """
+    prompt = request_tokens(reduce_request(model, prjMeta, [''] * count)) + summary_len * count
+    if count > 2 and max_tokens is not None and prompt > max_tokens:
+        half = (count + 1) // 2
+        parts = [reduce_estimate(model, prjMeta, half, summary_len, max_tokens), reduce_estimate(model, prjMeta, count - half, summary_len, max_tokens)]
+        requests, prompt, completion = reduce_estimate(model, prjMeta, 2, summary_len)
+        return requests + sum(part[0] for part in parts), prompt + sum(part[1] for part in parts), completion + sum(part[2] for part in parts)
+    return 1, prompt, summary_len
+
+def estimate(meta,
+             model,
+             summary_reps = 1,
+             batch_size = 1,
+             summary_len = 600,
+             completion_tokens = 250,
+             summary_tokens = None):
+    """
+    Pre-flight token and cost estimate for annotating a metadata table, no requests are sent.
+    Prompts are built exactly as summarize/jsonOut would build them, but summaries and completions don't
+    exist yet so they are assumed to be `summary_len` tokens long and `completion_tokens` per experiment.
+    `summary_tokens` is the annotate() limit, summaries over it are counted as the map-reduce requests summarize sends.
+    """
+    requests = 0
+    prompt = 0
+    completion = 0
+    for project_id in meta['project_id'].unique():
+        prj = meta[meta['project_id'] == project_id]
+        prjMeta = prj[['project_id','project_title','abstract','protocol']].drop_duplicates(subset='project_id', keep = 'first')
+        expMeta = exp_columns(prj).drop_duplicates(subset='experiment_id', keep = 'first')
+
+        # the summary_reps summaries are sampled in one request and distilled into one consensus summary
+        summary = request_tokens(summary_request(model, prjMeta, expMeta))
+        if summary_tokens is None or summary <= summary_tokens:
+            prompt += summary
+            completion += summary_len * summary_reps
+            requests += 1
+        else:
+            # one request per chunk, then summary_reps reductions of the chunk summaries
+            chunks = chunk_experiments(model, prjMeta, expMeta, summary_tokens)
+            for i, chunk in enumerate(chunks):
+                prompt += request_tokens(summary_request(model, prjMeta, chunk, part = (i + 1, len(chunks))))
+            completion += summary_len * summary_reps * len(chunks)
+            requests += len(chunks)
+            reduce_requests, reduce_prompt, reduce_completion = reduce_estimate(model, prjMeta, len(chunks), summary_len, summary_tokens)
+            requests += reduce_requests * summary_reps
+            prompt += reduce_prompt * summary_reps
+            completion += reduce_completion * summary_reps
+        if summary_reps > 1:
+            prompt += request_tokens(consensus_request(model, prjMeta, [''] * summary_reps)) + summary_len * summary_reps
+            completion += summary_len
+            requests += 1
+
+        for i in range(0, len(expMeta), batch_size):
+            batch = expMeta.iloc[i:i + batch_size]
+            prompt += request_tokens(json_request(model, '', batch, summary_reps, len(batch) > 1)) + summary_len
+            completion += completion_tokens * len(batch)
+            requests += 1
+
+    return {'model': model,
+            'projects': int(meta['project_id'].nunique()),
+            'experiments': int(meta['experiment_id'].nunique()),
+            'requests': requests,
+            'prompt_tokens': prompt,
+            'completion_tokens': completion,
+            'cost': token_cost(model, prompt, completion)}
+
 #### control functions
 
 # function the loop experiments for testing
@@ -160,8 +584,20 @@ def sampleExps(model,
                expMeta,
                project_summary,
                summary_reps,
-               sample = None):
-
+               sample = None,
+               workers = 1,
+               batch_size = 1,
+               done = None,
+               on_result = None,
+               fast_path = False,
+               dedup = False):
+    """
+    annotate the experiments of a project, returns a list of experiment_model in experiment order.
+    Experiments in `done` (experiment_id: annotation) are not sent again, `on_result` is called with
+    every new annotation as soon as its batch is validated.
+    With `fast_path` experiments that the rules in llomics.rules can classify from their title are not sent to the LLM.
+    With `dedup` only one experiment of each replicate group (see llomics.replicates) is sent, its annotation is copied to the others.
+    """
     exp_list = list(expMeta['experiment_id'].unique())
 
     if sample is not None and sample < len(expMeta):
@@ -170,135 +606,343 @@ def sampleExps(model,
 
     #project_summary = '\n'.join(project_summary)
     print(project_summary)
-    expMeta_list = []
-    for exp in exp_list:
+
+    def annotate_exp(exp):
         # get the experiment metadata from the full dataframe of experiments 
-        exp_details = expMeta[expMeta['experiment_id'] == exp][['experiment_id', 'title', 'attributes']]
-        print(f'annotating experiment {exp_details["experiment_id"]}')
+        exp_details = exp_columns(expMeta[expMeta['experiment_id'] == exp])
+        print(f'annotating experiment {exp}')
 
         json_response = jsonOut(model, 
                                 project_summary, 
                                 summary_reps = summary_reps,
                                 expMeta = exp_details)
         
-        json_out = experiment_model.model_validate_json(json_response.choices[0].message.function_call.arguments) 
-        expMeta_list.append(json_out)
+        return experiment_model.model_validate_json(json_response.choices[0].message.function_call.arguments) 
+
+    def annotate_batch(exps):
+        if len(exps) == 1:
+            return [annotate_exp(exps[0])]
+
+        exp_details = exp_columns(expMeta[expMeta['experiment_id'].isin(exps)]).drop_duplicates(subset = 'experiment_id')
+        print(f'annotating {len(exps)} experiments {exps[0]}...{exps[-1]}')
+
+        json_response = jsonOut(model,
+                                project_summary,
+                                summary_reps = summary_reps,
+                                expMeta = exp_details,
+                                batch = True)
+        try:
+            batch_out = batch_model.model_validate_json(json_response.choices[0].message.function_call.arguments).experimentMeta
+        except ValidationError:
+            batch_out = []
+
+        # keep only experiments that were requested and returned exactly once
+        counts = Counter(exp.experiment_id for exp in batch_out)
+        found = {exp.experiment_id: exp for exp in batch_out if counts[exp.experiment_id] == 1 and exp.experiment_id in exps}
+        missing = [exp for exp in exps if exp not in found]
+        if missing:
+            # split what is missing in half and retry, this bottoms out at single experiment requests
+            print(f'{len(missing)} of {len(exps)} experiments missing from batch response, retrying...')
+            half = (len(missing) + 1) // 2
+            for part in [missing[:half], missing[half:]]:
+                if part:
+                    found.update(zip(part, annotate_batch(part)))
+
+        return [found[exp] for exp in exps]
+
+    done = done or {}
+    todo = [exp for exp in exp_list if exp not in done]
+
+    ruled = {}
+    if fast_path:
+        exp_rows = expMeta.drop_duplicates(subset = 'experiment_id').set_index('experiment_id')
+        # the pairs keep the value boundaries that the joined attributes string loses
+        attributes = 'attribute_pairs' if 'attribute_pairs' in exp_rows else 'attributes'
+        for exp in todo:
+            fields = classify(exp, exp_rows.at[exp, 'title'], exp_rows.at[exp, attributes])
+            if fields is not None:
+                ruled[exp] = experiment_model.model_validate(fields)
+                if on_result is not None:
+                    on_result(ruled[exp])
+        metrics.count('fast_path', len(ruled))
+        print(f'{len(ruled)} of {len(todo)} experiments annotated by rules')
+        todo = [exp for exp in todo if exp not in ruled]
+
+    groups = {exp: [exp] for exp in todo}
+    if dedup:
+        groups, conflicts = replicate_groups(expMeta[expMeta['experiment_id'].isin(todo)])
+        metrics.count('replicates', len(todo) - len(groups))
+        print(f'{len(todo)} experiments in {len(groups)} replicate groups, {len(conflicts)} with conflicting attributes')
+        todo = list(groups)
+    titles = expMeta.drop_duplicates(subset = 'experiment_id').set_index('experiment_id')['title']
+
+    def run_batch(exps):
+        # keyed by the requested ids, the reply may not echo an id exactly
+        results = [exp.model_copy(update = {'experiment_id': requested, 'exp_title': titles[requested]}) for requested, exp in zip(exps, annotate_batch(exps))]
+        # copy each representative's annotation to the rest of its replicate group
+        fanned = [copy for exp in results for copy in fan_out(exp, groups[exp.experiment_id][1:], titles).values()]
+        if on_result is not None:
+            for exp in results + fanned:
+                on_result(exp)
+        return results + fanned
+
+    # experiments are independent so batches can be sent concurrently, map keeps the input order
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            batch_list = list(pool.map(run_batch, batches))
+    else:
+        batch_list = [run_batch(exps) for exps in batches]
+
+    annotated = {exp.experiment_id: exp for exps in batch_list for exp in exps}
+    annotated.update(ruled)
+    expMeta_list = [annotated[exp] if exp in annotated else experiment_model.model_validate(done[exp]) for exp in exp_list]
 
     return expMeta_list 
 
-def bool_check(df):
+def get_meta(prjid, store = None, offline = False):
     """
-    Check for inconsistencies between boolean and character variables
+    metadata table for a bioproject, from the SRA or from a local MetaStore (refreshed first unless offline)
     """
-    var_dict = {'mutation':'gene_mutation',
-                'deletion':'gene_deletion',
-                'depletion':'protein_depletion',
-                'stress':'stress_condition',
-                'time_point':'time_series'}
+    if store is None:
+        if offline:
+            raise ValueError("offline mode needs a metadata store")
+        return fetch.fetch(prjid)
 
-    # loop through the rows and check for inconsistencies
-    check = []
-    # for each row in the df, check if any of the bool and char variables disagree
-    for i in range(len(df)):
-        mismatch = False 
-        for var in var_dict:
+    if not offline:
+        with metrics.stage('fetch'):
+            store.refresh(prjid)
+    with metrics.stage('parse'):
+        return store.frame(prjid)
 
-            if df.loc[i, var_dict[var]] == False and pd.isnull(df.loc[i, var]) == False:
-                mismatch = True 
-            elif df.loc[i, var_dict[var]] == True and pd.isnull(df.loc[i, var]) == True:
-                mismatch = True
+def annotate_tier(model,
+                  prjMeta,
+                  expMeta,
+                  summary_reps = 1,
+                  sample = None,
+                  workers = 1,
+                  batch_size = 1,
+                  checkpoint = None,
+                  fast_path = False,
+                  dedup = False,
+                  summary_tokens = None,
+                  summary_meta = None):
+    """
+    summarize a project and annotate its experiments with one model, returns the annotation table.
+    `summary_meta` are the experiments the summary is made from when only some of them are annotated (default expMeta).
+    """
+    project_id = prjMeta['project_id'].iloc[0]
+    project_title = prjMeta['project_title'].iloc[0]
 
-        if mismatch:
-            check.append(True)
-        else:
-            check.append(False)
-    df['warning'] = check
+    if compact_prompts:
+        tokens = prompt_savings(prjMeta, expMeta.drop_duplicates(subset = 'experiment_id'), model, batch_size)
+        metrics.count('verbose_prompt_tokens', tokens['verbose'])
+        metrics.count('compact_prompt_tokens', tokens['compact'])
 
-    return df
+    done = {}
+    on_result = None
+    project_summary = None
+    if checkpoint is not None:
+        done = checkpoint.done(project_id, model)
+        on_result = lambda exp: checkpoint.add_experiment(project_id, model, exp)
+        project_summary = checkpoint.summary(project_id, model)
 
-def tagExps(annotated_exps):
-    
-    for row in range(len(annotated_exps)):
-        timepoint = str(annotated_exps.loc[row,'time_point']).replace(' ','_')
+    if project_summary is None:
+        with metrics.stage('summarize'):
+            project_summary, samples = consensus_summary(model,
+                                                         prjMeta,
+                                                         expMeta if summary_meta is None else summary_meta,
+                                                         summary_reps,
+                                                         max_tokens = summary_tokens,
+                                                         workers = workers)
+        if checkpoint is not None:
+            checkpoint.add_summary(project_id, model, project_summary, samples if len(samples) > 1 else None)
 
-        if annotated_exps.loc[row,'chip_input'] == True:
-            target = 'Input'
-        else:
-            target = annotated_exps.loc[row,'chip_target']
-        
-        if any(annotated_exps.loc[row,'gene_mutation':'stress_condition']):
-            if annotated_exps.loc[row,'gene_mutation']:
-                pertype = 'gene_mutation'
-                per = annotated_exps.loc[row,'mutation']
-            elif annotated_exps.loc[row,'gene_deletion']:
-                pertype = 'gene_deletion'
-                per = annotated_exps.loc[row,'deletion']
-            elif annotated_exps.loc[row,'protein_depletion']:
-                pertype = 'protein_depletion'
-                per = annotated_exps.loc[row,'depletion']
-            elif annotated_exps.loc[row,'stress_condition']:
-                pertype = 'stress_condition'
-                per = annotated_exps.loc[row,'stress'] 
-
-            if annotated_exps.loc[row,'time_series']:
-                annotated_exps.loc[row,'sample'] = f'{target}-{per}-{pertype}-{timepoint}'
-            else:
-                annotated_exps.loc[row,'sample'] = f'{target}-{per}-{pertype}'
+    with metrics.stage('annotate'):
+        expMeta_list = sampleExps(model,
+                                  expMeta,
+                                  project_summary,
+                                  summary_reps,
+                                  sample,
+                                  workers = workers,
+                                  batch_size = batch_size,
+                                  done = done,
+                                  on_result = on_result,
+                                  fast_path = fast_path,
+                                  dedup = dedup)
 
-            annotated_exps.loc[row,'perturbation'] = f'{pertype}'
+ ### handling response output ### 
+ # use the project_model class to format the experiment jsons under the parent project
+    output = project_model(project_id = project_id, 
+                           project_title = project_title, 
+                           experimentMeta = expMeta_list)        
 
-        else:
-            if annotated_exps.loc[row,'time_series']:
-                annotated_exps.loc[row,'sample'] = f'{target}-WT-{timepoint}'
-            else:
-                annotated_exps.loc[row,'sample'] = f'{target}-WT'
-
-            annotated_exps.loc[row,'perturbation'] = 'none'
-
-    return annotated_exps
-
-def setControl(annotated_proj):
-    # designed for grouped apply to projects within annotated table
-    # first find out what the controls are in the project if any
-    # then iterate the rows and match control to experiment
-    controls = pd.DataFrame()
-    exps = pd.DataFrame()
-    if not any(annotated_proj['chip_input']): # if there are no samples labelled as inputs
-        if any(annotated_proj['antibody_control']): # check if any are labelled as antibody controls
-            controls = annotated_proj[annotated_proj['antibody_control'] == True] # and if so then make a list of controls
-            exps = annotated_proj[annotated_proj['antibody_control'] == False] # and a list of experiments
-    else:
-        controls = annotated_proj[annotated_proj['chip_input'] == True]
-        exps = annotated_proj[annotated_proj['chip_input'] == False] # and a list of experiments
+    # validate and store the json output 
+    json_args = json.loads(output.model_dump_json())
 
-    for index, row in exps.iterrows():
-        if 'WT' in row['sample']:
-            if row['time_series']:
-                ctrl = controls.loc[(controls['gene_mutation'] == False) & (controls['gene_deletion'] == False) & (controls['protein_depletion'] == False) & (controls['stress_condition'] == False) & (controls['time_point'] == row['time_point']), 'sample']
-            else:
-                ctrl = controls.loc[(controls['gene_mutation'] == False) & (controls['gene_deletion'] == False) & (controls['protein_depletion'] == False) & (controls['stress_condition'] == False), 'sample']
-        else:
-            if row['gene_mutation']:
-                pertype = 'mutation'
-            elif row['gene_deletion']:
-                pertype = 'deletion'
-            elif row['protein_depletion']:
-                pertype = 'depletion'
-            elif row['stress_condition']:
-                pertype = 'stress'
-
-            if row['time_series']:
-                ctrl = controls[(controls[pertype].str.lower() == row[pertype].lower()) & (controls['time_point'] == row['time_point'])]['sample']
-            else:
-                ctrl = controls[(controls[pertype].str.lower() == row[pertype].lower())]['sample']
-        
-        if not ctrl.empty:
-            exps.loc[index, 'control'] = ctrl.iloc[0]
-        else:
-            exps.loc[index, 'control'] = 'None'
+    # convert json output to dataframe
+    expdf = pd.json_normalize(json_args['experimentMeta'])
+    expdf['project_id'] = project_id
+    expdf['model'] = model
+
+    return expdf
+
+def annotate_project(model,
+                     meta,
+                     summary_reps = 1,
+                     sample = None,
+                     workers = 1,
+                     batch_size = 1,
+                     checkpoint = None,
+                     fast_path = False,
+                     dedup = False,
+                     summary_tokens = None):
+    """
+    summarize a single project and annotate its experiments, returns the annotation table.
+    With a checkpoint, the summary and each annotation are saved as they are produced and
+    anything already in the checkpoint is reused.
+    With `dedup` replicates are annotated once, experiments whose title matches a replicate group
+    but whose attributes differ are marked in `replicate_conflict`.
+    `model` can be a list of models from cheapest to strongest: everything is annotated with the first one and the
+    experiments flagged by validate.cascade_check are re-annotated with the next one, and so on.
+    The `model` column records which model produced each row.
+    """
+    models = [model] if isinstance(model, str) else list(model)
+    prjMeta = meta[['project_id','project_title','abstract','protocol']].drop_duplicates(subset='project_id', keep = 'first')
+    expMeta = exp_columns(meta)
+
+    expdf = annotate_tier(models[0], prjMeta, expMeta, summary_reps, sample, workers, batch_size, checkpoint, fast_path, dedup, summary_tokens)
+
+    for stronger in models[1:]:
+        flagged = cascade_check(expdf)
+        if not flagged.any():
+            break
+        print(f'escalating {flagged.sum()} of {len(expdf)} experiments to {stronger}')
+        metrics.count('escalated', int(flagged.sum()))
+        escalate = expMeta[expMeta['experiment_id'].isin(expdf.loc[flagged, 'experiment_id'])]
+        # the stronger model still summarizes the whole project, controls and conditions included
+        escalated = annotate_tier(stronger, prjMeta, escalate, summary_reps, None, workers, batch_size, checkpoint, False, dedup, summary_tokens, summary_meta = expMeta)
+        # swap the escalated rows in, keeping the experiment order
+        order = expdf['experiment_id']
+        expdf = pd.concat([expdf[~flagged], escalated]).set_index('experiment_id').loc[order].reset_index()
 
-    annotated_proj = pd.concat([exps, controls])
-    return annotated_proj
+    if dedup:
+        conflicts = replicate_groups(expMeta)[1]
+        expdf['replicate_conflict'] = expdf['experiment_id'].isin(conflicts)
+
+    return expdf
+
+def annotate_iter(projects,
+                  model,
+                  validate = True,
+                  tag = True,
+                  sample = None,
+                  summary_reps = 1,
+                  workers = 1,
+                  batch_size = 1,
+                  store = None,
+                  offline = False,
+                  fetch_workers = 1,
+                  annotate_workers = 1,
+                  queue_depth = 2,
+                  meta = None,
+                  checkpoint = None,
+                  fast_path = False,
+                  dedup = False,
+                  summary_tokens = None):
+    """
+    Pipeline over a list of bioprojects that overlaps fetching with LLM work.
+    `fetch_workers` threads fetch metadata into a queue of at most `queue_depth` projects, while
+    `annotate_workers` threads summarize/annotate/tag them.
+    `meta` can map project ids to already fetched metadata tables.
+    Yields (project id, annotation table) as each project finishes.
+    """
+    if offline and store is not None:
+        # offline projects can only come from the store, don't skip the ones it doesn't have
+        missing = store.missing([prjid for prjid in projects if meta is None or prjid not in meta])
+        if missing:
+            raise ValueError(f"{len(missing)} projects are not in the metadata store {store.path}, refresh them first: {', '.join(missing)}")
+
+    todo = queue.Queue()
+    for prjid in projects:
+        todo.put(prjid)
+    fetched = queue.Queue(maxsize = queue_depth)
+    done = queue.Queue()
+    stop = threading.Event()
+    seen = set()
+    seen_lock = threading.Lock()
+
+    def fetcher():
+        while not stop.is_set():
+            try:
+                prjid = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                if meta is not None and prjid in meta:
+                    item = (prjid, meta[prjid])
+                else:
+                    item = (prjid, get_meta(prjid, store, offline))
+            except Exception as exc:
+                item = (prjid, exc)
+            # blocks while the annotation stage is behind
+            while not stop.is_set():
+                try:
+                    fetched.put(item, timeout = 0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    def annotator():
+        while not stop.is_set():
+            try:
+                prjid, prj_meta = fetched.get(timeout = 0.1)
+            except queue.Empty:
+                continue
+            try:
+                if isinstance(prj_meta, Exception):
+                    raise prj_meta
+                # experiments can be returned for more than one search term, annotate them once
+                with seen_lock:
+                    prj_meta = prj_meta[~prj_meta['experiment_id'].isin(seen)].drop_duplicates(subset='experiment_id', keep = 'first')
+                    seen.update(prj_meta['experiment_id'])
+                for project_id in prj_meta['project_id'].unique():
+                    expdf = annotate_project(model,
+                                             prj_meta[prj_meta['project_id'] == project_id],
+                                             summary_reps = summary_reps,
+                                             sample = sample,
+                                             workers = workers,
+                                             batch_size = batch_size,
+                                             checkpoint = checkpoint,
+                                             fast_path = fast_path,
+                                             dedup = dedup,
+                                             summary_tokens = summary_tokens)
+                    done.put((prjid, finalize(expdf, validate, tag)))
+            except BaseException as exc:
+                # hand every failure to the consumer so the pipeline never hangs on a dead worker
+                done.put((prjid, exc))
+            done.put((prjid, None))
+
+    threads = [threading.Thread(target = fetcher, daemon = True) for i in range(fetch_workers)]
+    threads += [threading.Thread(target = annotator, daemon = True) for i in range(annotate_workers)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        finished = 0
+        while finished < len(projects):
+            prjid, result = done.get()
+            if result is None:
+                finished += 1
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                yield prjid, result
+    finally:
+        # workers stop after the project they are on, wait so nothing keeps running after we return
+        stop.set()
+        for thread in threads:
+            thread.join()
 
 # default settings to 1 rep 1 sample for testing
 def annotate(input,
@@ -307,77 +951,132 @@ def annotate(input,
          tag = True,
          sample = None,
          summary_reps = 1,
-         outFile = None):
+         outFile = None,
+         workers = 1,
+         rpm = None,
+         tpm = None,
+         retries = 5,
+         batch_size = 1,
+         cache = None,
+         cache_read_only = False,
+         cache_max_entries = None,
+         cache_max_age = None,
+         store = None,
+         offline = False,
+         fetch_workers = 1,
+         annotate_workers = 1,
+         queue_depth = 2,
+         preflight = False,
+         report = None,
+         checkpoint = None,
+         resume = False,
+         fast_path = False,
+         dedup = False,
+         summary_tokens = None,
+         bulk = False,
+         organism = None,
+         compact = False,
+         protocol_tokens = 400):
 
     check_env()
+    metrics.reset()
+    set_limits(rpm, tpm, retries)
+    response_cache = set_cache(cache, read_only = cache_read_only, max_entries = cache_max_entries, max_age = cache_max_age)
 
-    if type(input) == list:
-        meta = pd.concat([fetch.fetch(prj) for prj in input]).drop_duplicates(subset='experiment_id', keep = 'first')    
-    elif type(input) == str:
-        meta = pd.DataFrame(fetch.fetch(input).drop_duplicates(subset='experiment_id', keep = 'first'))
-    elif type(input) not in ['str','list','pd.DataFrame']:
-        raise ValueError("Input must be a project_id, list of project_ids, or a pandas dataframe of processed metadata")
-
-    if type(input) == pd.DataFrame:
-        outdf = input
-    else:
-    # parse meta table, isolate individual projects and their experiments
-        unique_projects = meta['project_id'].unique() 
-
-        expdf_list = []
-        for project_id in unique_projects:
-            prjMeta = meta[meta['project_id'] == project_id][['project_id','project_title','abstract','protocol']].drop_duplicates(subset='project_id', keep = 'first')
-            expMeta = meta[meta['project_id'] == project_id][['project_id','experiment_id', 'title', 'attributes']]
-
-            project_title = prjMeta['project_title'].iloc[0]
-            #project_id = prjMeta['project_id'].iloc[0]
+    if isinstance(store, str):
+        store = MetaStore(store)
 
+    # a checkpoint opened here from a path is closed when the run ends
+    opened = None
+    if isinstance(checkpoint, str):
+        if os.path.exists(checkpoint) and os.path.getsize(checkpoint) > 0 and not resume:
+            raise ValueError(f"checkpoint {checkpoint} already exists, use resume = True to continue it")
+        checkpoint = opened = Checkpoint(checkpoint)
+        if resume:
+            print(f'resuming from {checkpoint.path} with {len(checkpoint)} annotated experiments')
 
-            summary = summarize(model,
-                                prjMeta,
-                                expMeta)
-            project_summary = summary.choices[0].message.content
-      #      summaries.append(project_summary)
+    # the prompt format only applies to this run, exp_text/project_text and batch exports keep their defaults afterwards
+    prompts = set_prompts(compact, protocol_tokens)
+    try:
+        meta = None
+        if isinstance(input, str) and input.endswith('.parquet'):
+            # attribute_pairs are kept, compact prompts factor the attributes from them
+            input = read_table(input)
+        if isinstance(input, pd.DataFrame) and is_metadata(input):
+            # a metadata table (eg. from fetch or write_table) is annotated project by project
+            meta = {prjid: group for prjid, group in input.groupby('project_id', sort = False, observed = True)}
+            input = list(meta)
 
-            expMeta_list = sampleExps(model,
-                                      expMeta,
-                                      project_summary,
-                                      summary_reps,
-                                      sample)
+        if isinstance(input, pd.DataFrame):
+            outdf = finalize(input, validate, tag)
+        elif isinstance(input, (str, list)):
+            projects = [input] if isinstance(input, str) else list(input)
 
-     ### handling response output ### 
-     # use the project_model class to format the experiment jsons under the parent project
-            output = project_model(project_id = project_id, 
-                                   project_title = project_title, 
-                                   experimentMeta = expMeta_list)        
+            if bulk and store is None and meta is None:
+                # one OR'd search for all the projects instead of one search per project,
+                # iter_records times the fetch and parse stages itself
+                meta = fetch.fetch_bulk(projects, organism = organism)
+            if preflight:
+                # everything has to be fetched before any LLM request to estimate the whole run
+                if meta is None:
+                    meta = {prjid: get_meta(prjid, store, offline) for prjid in projects}
+                # for a cascade only the first model is estimated, escalations depend on the answers
+                first_model = model if isinstance(model, str) else model[0]
+                run_estimate = estimate(pd.concat(meta.values()).drop_duplicates(subset='experiment_id', keep = 'first'), first_model, summary_reps, batch_size,
+                                        summary_tokens = summary_tokens)
+                metrics.estimate = run_estimate
+                print(f"Estimated {run_estimate['requests']} requests, ~{run_estimate['prompt_tokens']} prompt + ~{run_estimate['completion_tokens']} completion tokens, {dollars(run_estimate['cost'])}")
 
-            # validate and store the json output 
-            json_args = json.loads(output.model_dump_json())
-
-            # convert json output to dataframe
-            expdf = pd.json_normalize(json_args['experimentMeta'])
-            expdf['project_id'] = project_id
-            expdf['model'] = model
-            #expdf['summary'] = '\n'.join(summaries)
-            expdf_list.append(expdf)
-
-        outdf = pd.concat(expdf_list, ignore_index=True)
+            results = annotate_iter(projects,
+                                    model,
+                                    validate = validate,
+                                    tag = tag,
+                                    sample = sample,
+                                    summary_reps = summary_reps,
+                                    workers = workers,
+                                    batch_size = batch_size,
+                                    store = store,
+                                    offline = offline,
+                                    fetch_workers = fetch_workers,
+                                    annotate_workers = annotate_workers,
+                                    queue_depth = queue_depth,
+                                    meta = meta,
+                                    checkpoint = checkpoint,
+                                    fast_path = fast_path,
+                                    dedup = dedup,
+                                    summary_tokens = summary_tokens)
+            # projects finish in any order, keep the output in input order
+            expdf_list = sorted(results, key = lambda result: projects.index(result[0]))
+            outdf = pd.concat([expdf for prjid, expdf in expdf_list], ignore_index = True) if expdf_list else pd.DataFrame()
+        else:
+            raise ValueError("Input must be a project_id, list of project_ids, a metadata or annotation dataframe, or a .parquet file of one")
+    finally:
+        if opened is not None:
+            opened.close()
+        set_prompts(*prompts)
 
     print(outdf)
-    if validate:
-        outdf = bool_check(outdf)
-
-    if tag:
-       outdf = tagExps(outdf) 
-       outdf = outdf.groupby('project_id').apply(setControl)
 
     if outFile is not None:
-        basename = outFile.split('.')[0]
-        outdf.to_csv(f'{basename}_FULL.csv', index = False, sep = ',')
-        if tag:
-            outdf[['project_id','experiment_id','exp_title','perturbation','sample','control','warning']].to_csv(outFile, index = False, sep = ',')
-        else:
-            outdf[['project_id','experiment_id','exp_title','perturbation','sample']].to_csv(outFile, index = False, sep = ',')
-    return outdf
+        write_output(outdf, outFile, tag)
 
+    if response_cache is not None:
+        print(f'response cache: {response_cache.stats()}')
 
+    usage = metrics.report()
+    if fast_path:
+        print(f"fast path: {usage['counters'].get('fast_path', 0)} experiments annotated without an LLM call")
+    if dedup:
+        print(f"dedup: {usage['counters'].get('replicates', 0)} replicate experiments annotated without an LLM call")
+    if compact:
+        verbose = usage['counters'].get('verbose_prompt_tokens', 0)
+        saved = verbose - usage['counters'].get('compact_prompt_tokens', 0)
+        print(f"compact prompts: {saved} of {verbose} metadata prompt tokens saved ({saved / verbose:.0%})" if verbose else "compact prompts: nothing sent")
+    if not isinstance(model, str):
+        print(f"cascade: {usage['counters'].get('escalated', 0)} experiments escalated")
+    for call in usage['calls']:
+        print(f"{call['kind']} ({call['model']}): {call['requests']} requests, {call['cached']} cached, {call['prompt_tokens']} prompt + {call['completion_tokens']} completion tokens, {dollars(call['cost'])}")
+    if report is not None:
+        metrics.to_json(report)
+
+    return outdf
@@ -0,0 +1,184 @@
+# OpenAI Batch API export/import for bulk annotation at batch pricing
+# jsonOut prompts need the project summaries, so a bulk run is two batch rounds:
+#   1. export_summaries -> submit -> read_summaries
+#   2. export_annotations (with the summaries) -> submit -> read_annotations
+# with summary_reps > 1 the sampled summaries go through export_consensus -> submit -> read_summaries between the two
+import os
+import json
+import pandas as pd
+from collections import Counter
+from pydantic import ValidationError
+from llomics.annotate import summary_request, consensus_request, json_request, exp_columns, experiment_model, batch_model, finalize
+
+def project_tables(meta):
+    """
+    (project_id, prjMeta, expMeta) for every project in a metadata table, in a deterministic order
+    """
+    for project_id in sorted(meta['project_id'].unique()):
+        prj = meta[meta['project_id'] == project_id]
+        prjMeta = prj[['project_id','project_title','abstract','protocol']].drop_duplicates(subset='project_id', keep = 'first')
+        expMeta = exp_columns(prj).drop_duplicates(subset='experiment_id', keep = 'first')
+        yield project_id, prjMeta, expMeta
+
+def write_requests(requests, path):
+    """
+    write (custom_id, request) pairs as a Batch API input file, returns the number of requests
+    """
+    n = 0
+    with open(path, 'w', encoding = 'utf-8') as out:
+        for custom_id, request in requests:
+            out.write(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions', 'body': request}, ensure_ascii = False) + '\n')
+            n += 1
+    print(f'wrote {n} requests to {path}')
+    return n
+
+def read_results(path):
+    """
+    generator of (custom_id, response body or None, error) from a Batch API output file
+    """
+    with open(path, encoding = 'utf-8') as results:
+        for line in results:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get('response') or {}
+            if result.get('error') or response.get('status_code') != 200:
+                yield result['custom_id'], None, result.get('error') or response.get('body')
+            else:
+                yield result['custom_id'], response['body'], None
+
+def export_summaries(meta, model, path, summary_reps = 1):
+    """
+    batch input file with one summarize request per project, custom_id 'summarize:{project_id}'.
+    With `summary_reps` > 1 each request samples that many summaries.
+    """
+    requests = ((f'summarize:{project_id}', summary_request(model, prjMeta, expMeta, n = summary_reps)) for project_id, prjMeta, expMeta in project_tables(meta))
+    return write_requests(requests, path)
+
+def export_consensus(meta, model, samples, path):
+    """
+    batch input file distilling the sampled summaries of each project ({project_id: [summaries]}, from read_summaries)
+    into one consensus summary, custom_id 'consensus:{project_id}'. Read the results with read_summaries.
+    """
+    requests = ((f'consensus:{project_id}', consensus_request(model, prjMeta, samples[project_id])) for project_id, prjMeta, expMeta in project_tables(meta) if project_id in samples)
+    return write_requests(requests, path)
+
+def read_summaries(path):
+    """
+    {project_id: summary} from the results of export_summaries or export_consensus,
+    a list of summaries for projects that were sampled more than once
+    """
+    summaries = {}
+    for custom_id, body, error in read_results(path):
+        project_id = custom_id.split(':', 1)[1]
+        if body is None:
+            print(f'{custom_id} failed: {error}')
+            continue
+        choices = [choice['message']['content'] for choice in body['choices']]
+        summaries[project_id] = choices[0] if len(choices) == 1 else choices
+    return summaries
+
+def ids_path(path):
+    root, ext = os.path.splitext(path)
+    return f'{root}_ids.json'
+
+def export_annotations(meta,
+                       model,
+                       summaries,
+                       path,
+                       summary_reps = 1,
+                       batch_size = 1,
+                       experiments = None):
+    """
+    batch input file with jsonOut requests for every experiment of the summarized projects,
+    or only for `experiments` (eg. the `missing` of read_annotations, to re-export them).
+    With `summary_reps` > 1 `summaries` are the consensus summaries from export_consensus.
+    custom_id is 'jsonOut:{project_id}:{first experiment_id}:{number of experiments}', the requested
+    experiment ids of every custom_id are written to <path>_ids.json for read_annotations.
+    """
+    ids = {}
+    def requests():
+        for project_id, prjMeta, expMeta in project_tables(meta):
+            if project_id not in summaries:
+                print(f'no summary for {project_id}, skipping')
+                continue
+            if experiments is not None:
+                expMeta = expMeta[expMeta['experiment_id'].isin(experiments)]
+            for i in range(0, len(expMeta), batch_size):
+                batch = expMeta.iloc[i:i + batch_size]
+                custom_id = f"jsonOut:{project_id}:{batch['experiment_id'].iloc[0]}:{len(batch)}"
+                ids[custom_id] = list(batch['experiment_id'])
+                yield custom_id, json_request(model, summaries[project_id], batch, summary_reps, len(batch) > 1)
+
+    n = write_requests(requests(), path)
+    with open(ids_path(path), 'w', encoding = 'utf-8') as out:
+        json.dump(ids, out)
+    return n
+
+def read_annotations(path,
+                     validate = True,
+                     tag = True,
+                     ids = None):
+    """
+    validate the results of export_annotations with experiment_model and build the annotation table,
+    then flag/tag it like annotate() does. Failed or invalid results are reported and skipped.
+    `ids` is the <input>_ids.json written by export_annotations (or its dict): only requested experiments
+    returned exactly once are kept, like the batches of sampleExps, and the requested experiments without
+    an annotation are reported and listed in the table's attrs['missing'] to be re-exported.
+    Without it experiments are only checked against the count in the custom_id.
+    """
+    if isinstance(ids, str):
+        with open(ids, encoding = 'utf-8') as sidecar:
+            ids = json.load(sidecar)
+
+    rows = []
+    missing = []
+    seen = set()
+    for custom_id, body, error in read_results(path):
+        seen.add(custom_id)
+        kind, project_id, first, n = custom_id.split(':')
+        requested = ids.get(custom_id) if ids is not None else None
+        if body is None:
+            print(f'{custom_id} failed: {error}')
+            missing += requested or []
+            continue
+
+        arguments = body['choices'][0]['message']['function_call']['arguments']
+        try:
+            if int(n) == 1:
+                experiments = [experiment_model.model_validate_json(arguments)]
+                if requested is not None:
+                    # a single experiment reply is the requested experiment, whatever id it echoes
+                    experiments = [experiments[0].model_copy(update = {'experiment_id': requested[0]})]
+            else:
+                experiments = batch_model.model_validate_json(arguments).experimentMeta
+        except ValidationError as exc:
+            print(f'{custom_id} is not a valid experiment_model: {exc}')
+            missing += requested or []
+            continue
+
+        if requested is not None:
+            counts = Counter(experiment.experiment_id for experiment in experiments)
+            duplicated = [experiment for experiment in requested if counts[experiment] > 1]
+            experiments = [experiment for experiment in experiments if experiment.experiment_id in requested and counts[experiment.experiment_id] == 1]
+            returned = {experiment.experiment_id for experiment in experiments}
+            lost = [experiment for experiment in requested if experiment not in returned]
+            if lost:
+                print(f'{custom_id}: {len(lost)} of {len(requested)} experiments missing or duplicated ({len(duplicated)} duplicated)')
+            missing += lost
+        elif len(experiments) != int(n):
+            print(f'{custom_id}: {len(experiments)} experiments returned for {n} requested')
+
+        for experiment in experiments:
+            rows.append(dict(experiment.model_dump(), project_id = project_id, model = body['model']))
+
+    if ids is not None:
+        # requests without a result line at all
+        missing += [experiment for custom_id, requested in ids.items() if custom_id not in seen for experiment in requested]
+    if missing:
+        print(f'{len(missing)} experiments without an annotation, re-export them with export_annotations(..., experiments = df.attrs["missing"])')
+
+    outdf = pd.DataFrame(rows).drop_duplicates(subset = 'experiment_id', keep = 'first')
+    outdf = finalize(outdf, validate, tag)
+    outdf.attrs['missing'] = missing
+    return outdf
@@ -0,0 +1,140 @@
+# offline benchmarks of the llomics pipeline stages on synthetic SRA metadata with a mock OpenAI client
+# python -m llomics.bench --projects 10 --experiments 50 --latency 0.05 --workers 8
+import io
+import json
+import time
+import argparse
+import importlib
+import tracemalloc
+import contextlib
+import numpy as np
+import pandas as pd
+from llomics.mock import synthetic_xml, MockClient
+from llomics.fetch import iter_packages, parse_package, records_frame
+from llomics.validate import bool_check
+
+annotate = importlib.import_module('llomics.annotate')
+
+def measure(fn, memory = True):
+    """
+    run `fn` and return (result, seconds, peak MB) of the timed run.
+    Peak memory comes from a second run under tracemalloc so it doesn't slow the timed run.
+    """
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+
+    return result, seconds, peak
+
+def percentiles(latencies):
+    if not latencies:
+        return {}
+    return {f'p{q}': float(np.percentile(latencies, q)) for q in [50, 90, 99]}
+
+def stage(name, items, seconds, peak, **extra):
+    report = {'stage': name, 'items': items, 'seconds': seconds, 'per_second': items / seconds if seconds else None, 'peak_mb': peak}
+    report.update(extra)
+    return report
+
+def bench_parse(xml, memory = True):
+    def parse():
+        records = (parse_package(element) for element in iter_packages(io.BytesIO(xml)))
+        return records_frame(record for record in records if record is not None)
+
+    meta, seconds, peak = measure(parse, memory)
+    return meta, stage('parse', len(meta), seconds, peak, mb = len(xml) / 1e6)
+
+def bench_prompts(meta, memory = True):
+    projects = [group for project_id, group in meta.groupby('project_id')]
+
+    def prompts():
+        return [annotate.project_text(group) + annotate.exp_text(group) for group in projects]
+
+    texts, seconds, peak = measure(prompts, memory)
+    # metadata tokens in the verbose and the compact prompt format
+    savings = [annotate.prompt_savings(group.iloc[:1], annotate.exp_columns(group), 'gpt-4o') for group in projects]
+    return stage('prompts', len(meta), seconds, peak, characters = sum(len(text) for text in texts),
+                 tokens = sum(tokens['verbose'] for tokens in savings), compact_tokens = sum(tokens['compact'] for tokens in savings))
+
+def bench_annotate(meta, latency, jitter, workers, batch_size, memory = True):
+    projects = [group for project_id, group in meta.groupby('project_id')]
+
+    def annotate_all():
+        # a fresh client per run, the latencies reported are the timed run's
+        client = MockClient(latency, jitter)
+        annotate.client = client
+        # sampleExps prints every experiment, keep the benchmark output readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            return [annotate.sampleExps('mock', group, 'summary', 1, workers = workers, batch_size = batch_size) for group in projects], client.latencies
+
+    (results, latencies), seconds, peak = measure(annotate_all, memory)
+    report = stage('annotate', len(meta), seconds, peak, requests = len(latencies),
+                   latency = percentiles(latencies), workers = workers, batch_size = batch_size)
+
+    rows = [exp.model_dump() for exps in results for exp in exps]
+    annotated = pd.DataFrame(rows)
+    annotated['project_id'] = [project_id for project_id, group in meta.groupby('project_id') for i in range(len(group))]
+    return annotated, report
+
+def bench_tag(annotated, memory = True):
+    def tag():
+        df = bool_check(annotated.copy())
+        df = annotate.tagExps(df)
+        return annotate.setControl(df)
+
+    tagged, seconds, peak = measure(tag, memory)
+    return stage('tag', len(tagged), seconds, peak)
+
+def run(projects = 10,
+        experiments = 50,
+        latency = 0.05,
+        jitter = 0.0,
+        workers = 8,
+        batch_size = 1,
+        memory = True):
+    """
+    run every stage and return a list of per-stage reports
+    """
+    xml = synthetic_xml(projects, experiments)
+    meta, parse_report = bench_parse(xml, memory)
+    reports = [parse_report, bench_prompts(meta, memory)]
+    annotated, annotate_report = bench_annotate(meta, latency, jitter, workers, batch_size, memory)
+    reports += [annotate_report, bench_tag(annotated, memory)]
+    return reports
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'benchmark llomics stages offline')
+    parser.add_argument('--projects', type = int, default = 10)
+    parser.add_argument('--experiments', type = int, default = 50, help = 'experiments per project')
+    parser.add_argument('--latency', type = float, default = 0.05, help = 'mock LLM latency in seconds')
+    parser.add_argument('--jitter', type = float, default = 0.0, help = 'extra random mock LLM latency in seconds')
+    parser.add_argument('--workers', type = int, default = 8)
+    parser.add_argument('--batch-size', type = int, default = 1)
+    parser.add_argument('--no-memory', action = 'store_true', help = 'skip peak memory measurement')
+    parser.add_argument('--json', help = 'write the report to this file')
+    args = parser.parse_args(argv)
+
+    reports = run(args.projects, args.experiments, args.latency, args.jitter, args.workers, args.batch_size, not args.no_memory)
+
+    for report in reports:
+        peak = f"{report['peak_mb']:8.1f} MB" if report['peak_mb'] is not None else '        -   '
+        line = f"{report['stage']:<10}{report['items']:>8} items {report['seconds']:9.3f} s {report['per_second']:12.1f} /s {peak}"
+        if report.get('compact_tokens'):
+            line += f"  prompt tokens {report['tokens']} -> {report['compact_tokens']} compact"
+        if report.get('latency'):
+            line += '  latency ' + ' '.join(f'{q} {value * 1000:.0f}ms' for q, value in report['latency'].items())
+        print(line)
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(reports, out, indent = 2)
+
+if __name__ == '__main__':
+    main()
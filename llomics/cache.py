@@ -0,0 +1,91 @@
+# persistent on-disk cache of LLM responses, keyed on a hash of the full request
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+class CacheMiss(LookupError):
+    pass
+
+class ResponseCache:
+    """
+    SQLite backed cache of chat completion responses.
+    Entries are keyed on a hash of the request (model, messages, function schema, temperature, ...).
+    `max_entries` and `max_age` (seconds) bound the cache size, least recently used entries are evicted first.
+    A `read_only` cache never writes and raises CacheMiss for unseen requests, for reproducible reruns.
+    """
+    def __init__(self,
+                 path,
+                 max_entries = None,
+                 max_age = None,
+                 read_only = False):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.lock = threading.Lock()
+
+        if read_only:
+            self.db = sqlite3.connect(f'file:{path}?mode=ro', uri = True, check_same_thread = False)
+        else:
+            self.db = sqlite3.connect(path, check_same_thread = False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, created REAL, accessed REAL)')
+            self.db.commit()
+            self.evict()
+
+    @staticmethod
+    def key(request):
+        text = json.dumps(request, sort_keys = True, ensure_ascii = False, default = str)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+            # entries older than max_age are misses even before eviction gets to them
+            if row is not None and self.max_age is not None and row[1] < time.time() - self.max_age:
+                if not self.read_only:
+                    self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    self.db.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self.db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+                self.db.commit()
+            return row[0]
+
+    def put(self, key, response):
+        if self.read_only:
+            return
+        with self.lock:
+            now = time.time()
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', (key, response, now, now))
+            self.db.commit()
+            self.puts += 1
+        if self.max_entries is not None and self.puts % 100 == 0:
+            self.evict()
+
+    def evict(self):
+        if self.read_only:
+            return
+        with self.lock:
+            if self.max_age is not None:
+                self.db.execute('DELETE FROM responses WHERE created < ?', (time.time() - self.max_age,))
+            if self.max_entries is not None:
+                self.db.execute('DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY accessed DESC LIMIT ?)', (self.max_entries,))
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            entries = self.db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,102 @@
+# durable checkpoint of annotation results so long runs can be resumed
+import os
+import json
+import threading
+import pandas as pd
+
+class Checkpoint:
+    """
+    Append-only JSONL log of project summaries and validated experiment annotations.
+    Every record is flushed and fsynced as soon as it is produced, so a crashed run keeps every paid LLM call.
+    When a file is reopened its records are loaded, later records for the same project/experiment win.
+    Records are kept per model so a model cascade can reuse the results of every tier.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.summaries = {}
+        self.experiments = {}
+        # experiment_id: key of its latest record in experiments
+        self.latest = {}
+
+        if os.path.exists(path):
+            with open(path, 'rb+') as log:
+                data = log.read()
+                # a crash mid-write leaves a partial last line, cut it so the next record starts on its own line
+                end = data.rfind(b'\n') + 1
+                if end < len(data):
+                    log.truncate(end)
+            for line in data[:end].decode('utf-8').splitlines():
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self._load(record)
+
+        self.log = open(path, 'a', encoding = 'utf-8')
+
+    def __len__(self):
+        return len(self.latest)
+
+    def _load(self, record):
+        if record['type'] == 'summary':
+            self.summaries[(record['project_id'], record['model'])] = record
+            self.summaries[(record['project_id'], None)] = record
+        elif record['type'] == 'experiment':
+            key = (record['annotation']['experiment_id'], record['model'])
+            self.experiments[key] = record
+            self.latest[key[0]] = key
+
+    def _write(self, record):
+        with self.lock:
+            self.log.write(json.dumps(record, ensure_ascii = False) + '\n')
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            self._load(record)
+
+    def add_summary(self, project_id, model, summary, samples = None):
+        # with summary_reps > 1 `summary` is the consensus and `samples` the summaries it was distilled from
+        record = {'type': 'summary', 'project_id': project_id, 'model': model, 'summary': summary}
+        if samples is not None:
+            record['samples'] = samples
+        self._write(record)
+
+    def add_experiment(self, project_id, model, experiment):
+        self._write({'type': 'experiment', 'project_id': project_id, 'model': model, 'annotation': experiment.model_dump()})
+
+    def summary(self, project_id, model = None):
+        """
+        latest summary of a project, by `model` if given
+        """
+        record = self.summaries.get((project_id, model))
+        return record['summary'] if record else None
+
+    def done(self, project_id, model = None):
+        """
+        annotations already in the checkpoint for a project (by `model` if given), as {experiment_id: annotation dict}
+        """
+        with self.lock:
+            if model is None:
+                records = [self.experiments[key] for key in self.latest.values()]
+            else:
+                records = [record for (experiment_id, record_model), record in self.experiments.items() if record_model == model]
+            return {record['annotation']['experiment_id']: record['annotation'] for record in records if record['project_id'] == project_id}
+
+    def frame(self, project_ids = None):
+        """
+        rebuild the annotation table (same columns as annotate_project) from the checkpoint
+        """
+        with self.lock:
+            records = [self.experiments[key] for key in self.latest.values()]
+            records = [record for record in records if project_ids is None or record['project_id'] in project_ids]
+        rows = [dict(record['annotation'], project_id = record['project_id'], model = record['model']) for record in records]
+        return pd.DataFrame(rows)
+
+    def close(self):
+        self.log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
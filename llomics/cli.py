@@ -0,0 +1,179 @@
+# llomics command line, each subcommand imports only the modules it needs
+# llomics fetch PRJNA721183 -o meta.csv
+# llomics annotate PRJNA721183 --model gpt-4o-mini gpt-4o -o annotated.csv
+# llomics tag annotated_FULL.csv -o tagged.csv
+# llomics shard run manifest.txt --index 0 --count 8 -m gpt-4o-mini -d parts
+# llomics shard merge parts -o annotated.csv
+import argparse
+
+def run_fetch(args):
+    import pandas as pd
+    if args.store is not None:
+        from llomics.store import MetaStore
+        store = MetaStore(args.store)
+        frames = []
+        for prjid in args.projects:
+            if not args.offline:
+                store.refresh(prjid, batch_size = args.batch_size, workers = args.workers)
+            frames.append(store.frame(prjid))
+        store.close()
+    else:
+        from llomics.fetch import fetch_bulk
+        frames = list(fetch_bulk(args.projects, batch_size = args.batch_size, workers = args.workers, organism = args.organism).values())
+
+    meta = pd.concat(frames) if frames else pd.DataFrame()
+    if args.output.endswith('.parquet'):
+        from llomics.columnar import write_table
+        write_table(meta, args.output)
+    else:
+        meta.drop(columns = 'attribute_pairs', errors = 'ignore').to_csv(args.output, index = False)
+    print(f'{len(meta)} records from {len(args.projects)} projects written to {args.output}')
+
+def annotate_options(args):
+    # annotate() arguments shared by annotate and shard run
+    return dict(sample = args.sample,
+                summary_reps = args.summary_reps,
+                workers = args.workers,
+                rpm = args.rpm,
+                tpm = args.tpm,
+                retries = args.retries,
+                batch_size = args.batch_size,
+                cache = args.cache,
+                cache_read_only = args.cache_read_only,
+                cache_max_entries = args.cache_max_entries,
+                cache_max_age = args.cache_max_age,
+                store = args.store,
+                offline = args.offline,
+                fetch_workers = args.fetch_workers,
+                annotate_workers = args.annotate_workers,
+                preflight = args.preflight,
+                report = args.report,
+                fast_path = args.fast_path,
+                dedup = args.dedup,
+                summary_tokens = args.summary_tokens,
+                bulk = args.bulk,
+                organism = args.organism,
+                compact = args.compact,
+                protocol_tokens = args.protocol_tokens)
+
+def run_annotate(args):
+    from llomics.annotate import annotate
+    model = args.model[0] if len(args.model) == 1 else args.model
+    annotate(args.projects if len(args.projects) > 1 else args.projects[0],
+             model,
+             validate = not args.no_validate,
+             tag = not args.no_tag,
+             outFile = args.output,
+             checkpoint = args.checkpoint,
+             resume = args.resume,
+             **annotate_options(args))
+
+def run_shard(args):
+    from llomics.shard import run_shard as annotate_shard
+    model = args.model[0] if len(args.model) == 1 else args.model
+    options = annotate_options(args)
+    if args.checkpoint is not None:
+        options['checkpoint'] = args.checkpoint
+    annotate_shard(args.manifest, args.index, args.count, model, args.dir, format = args.format, overwrite = args.overwrite, **options)
+
+def run_merge(args):
+    from llomics.shard import merge
+    merge(args.dir, args.output, validate = not args.no_validate, tag = not args.no_tag, manifest = args.manifest)
+
+def run_tag(args):
+    from llomics.tag import finalize, read_output
+    annotated = read_output(args.input)
+    tagged = finalize(annotated, validate = not args.no_validate, tag = True)
+    if args.output.endswith('.parquet'):
+        from llomics.columnar import write_table
+        write_table(tagged, args.output)
+    else:
+        tagged.to_csv(args.output, index = False)
+    print(f'{len(tagged)} experiments tagged, written to {args.output}')
+
+def add_annotate_options(command):
+    command.add_argument('--sample', type = int)
+    command.add_argument('--summary-reps', type = int, default = 1, help = 'summaries sampled per project and distilled into one consensus summary')
+    command.add_argument('--summary-tokens', type = int, help = 'map-reduce project summaries over this many prompt tokens')
+    command.add_argument('--workers', type = int, default = 1)
+    command.add_argument('--batch-size', type = int, default = 1)
+    command.add_argument('--rpm', type = float)
+    command.add_argument('--tpm', type = float)
+    command.add_argument('--retries', type = int, default = 5)
+    command.add_argument('--cache')
+    command.add_argument('--cache-read-only', action = 'store_true')
+    command.add_argument('--cache-max-entries', type = int)
+    command.add_argument('--cache-max-age', type = float, help = 'seconds, older cached responses are not used')
+    command.add_argument('--store')
+    command.add_argument('--offline', action = 'store_true')
+    command.add_argument('--fetch-workers', type = int, default = 1)
+    command.add_argument('--annotate-workers', type = int, default = 1)
+    command.add_argument('--preflight', action = 'store_true')
+    command.add_argument('--report', help = 'write run metrics to this json file')
+    command.add_argument('--fast-path', action = 'store_true')
+    command.add_argument('--dedup', action = 'store_true')
+    command.add_argument('--bulk', action = 'store_true', help = 'fetch all the projects with batched searches before annotating')
+    command.add_argument('--organism', help = 'with --bulk, only fetch records of this organism')
+    command.add_argument('--compact', action = 'store_true', help = 'compact prompts, experiments as a table and a shortened protocol')
+    command.add_argument('--protocol-tokens', type = int, default = 400)
+
+def parser():
+    parser = argparse.ArgumentParser(prog = 'llomics', description = 'LLM annotation of SRA ChIP-seq metadata')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    fetch = commands.add_parser('fetch', help = 'fetch SRA metadata for bioprojects to a csv')
+    fetch.add_argument('projects', nargs = '+', help = 'bioproject ids')
+    fetch.add_argument('-o', '--output', required = True, help = 'csv, or .parquet for a compact table')
+    fetch.add_argument('--store', help = 'sqlite metadata store to refresh and read from')
+    fetch.add_argument('--offline', action = 'store_true', help = 'read from --store without contacting the SRA')
+    fetch.add_argument('--organism', help = 'only fetch records of this organism, eg. "Saccharomyces cerevisiae"')
+    fetch.add_argument('--batch-size', type = int, default = 500)
+    fetch.add_argument('--workers', type = int, default = 3)
+    fetch.set_defaults(run = run_fetch)
+
+    annotate = commands.add_parser('annotate', help = 'annotate the experiments of bioprojects')
+    annotate.add_argument('projects', nargs = '+', help = 'bioproject ids, or a metadata .parquet file written by llomics fetch')
+    annotate.add_argument('-m', '--model', nargs = '+', required = True, help = 'model, or models from cheapest to strongest for a cascade')
+    annotate.add_argument('-o', '--output', required = True, help = 'csv of sample tags, the full table goes to <output>_FULL.csv')
+    annotate.add_argument('--no-validate', action = 'store_true')
+    annotate.add_argument('--no-tag', action = 'store_true')
+    annotate.add_argument('--checkpoint')
+    annotate.add_argument('--resume', action = 'store_true')
+    add_annotate_options(annotate)
+    annotate.set_defaults(run = run_annotate)
+
+    tag = commands.add_parser('tag', help = 'flag, tag and match controls for an annotation table csv')
+    tag.add_argument('input', help = 'annotation table, eg. the _FULL.csv written by annotate')
+    tag.add_argument('-o', '--output', required = True)
+    tag.add_argument('--no-validate', action = 'store_true')
+    tag.set_defaults(run = run_tag)
+
+    shard = commands.add_parser('shard', help = 'annotate a large manifest of bioprojects in independent shards')
+    shard_commands = shard.add_subparsers(dest = 'shard_command', required = True)
+    run = shard_commands.add_parser('run', help = 'annotate one shard of a manifest')
+    run.add_argument('manifest', help = 'text file of bioproject ids (one per line), csv with a project_id column, or metadata .parquet')
+    run.add_argument('--index', type = int, required = True, help = 'shard to run, 0 to count - 1')
+    run.add_argument('--count', type = int, required = True, help = 'number of shards')
+    run.add_argument('-m', '--model', nargs = '+', required = True)
+    run.add_argument('-d', '--dir', required = True, help = 'directory for the part files')
+    run.add_argument('--format', choices = ['csv', 'parquet'], default = 'csv')
+    run.add_argument('--overwrite', action = 'store_true', help = 'run the shard again even if its part exists')
+    run.add_argument('--checkpoint', help = 'default <dir>/part-<index>-of-<count>.checkpoint.jsonl')
+    add_annotate_options(run)
+    run.set_defaults(run = run_shard)
+    merge = shard_commands.add_parser('merge', help = 'combine the parts of a shard run, validate and tag them')
+    merge.add_argument('dir', help = 'directory with the part files')
+    merge.add_argument('-o', '--output', required = True, help = 'csv of sample tags, the full table goes to <output>_FULL.csv')
+    merge.add_argument('--manifest', help = 'put the projects back in manifest order')
+    merge.add_argument('--no-validate', action = 'store_true')
+    merge.add_argument('--no-tag', action = 'store_true')
+    merge.set_defaults(run = run_merge)
+
+    return parser
+
+def main(argv = None):
+    args = parser().parse_args(argv)
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
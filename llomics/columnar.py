@@ -0,0 +1,86 @@
+# parquet storage for metadata and annotation tables, needs pyarrow (pip install llomics[parquet])
+import os
+import pandas as pd
+from llomics.fetch import header
+
+# low cardinality columns stored as categoricals
+categories = ['organism', 'assay_id', 'perturbation', 'model']
+# project level text, stored once per project for metadata tables
+project_columns = ['project_id', 'project_title', 'abstract', 'protocol']
+
+def check_parquet():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('parquet files need pyarrow, install it with `pip install llomics[parquet]` or `pip install pyarrow`')
+
+def projects_path(path):
+    root, ext = os.path.splitext(path)
+    return f'{root}_projects{ext}'
+
+def is_metadata(df):
+    """
+    True for a metadata table (fetch output), False for an annotation table
+    """
+    return 'attributes' in df or 'attribute_pairs' in df
+
+def compact(df):
+    """
+    copy of a table with categorical dtypes and attribute pairs as a list of {key, value} structs
+    """
+    df = df.copy()
+    for column in categories:
+        if column in df:
+            df[column] = df[column].astype('category')
+    if 'attribute_pairs' in df:
+        # the joined attributes string is rebuilt from the pairs when the table is read
+        df['attribute_pairs'] = [[{'key': key, 'value': value} for key, value in pairs] for pairs in df['attribute_pairs']]
+        df = df.drop(columns = 'attributes', errors = 'ignore')
+    return df
+
+def write_table(df, path):
+    """
+    Write a metadata or annotation table as parquet. For metadata tables the project title, abstract and
+    protocol go to a separate <path>_projects.parquet table, once per project.
+    """
+    check_parquet()
+    df = compact(df)
+    if 'abstract' in df:
+        projects = df[project_columns].drop_duplicates(subset = 'project_id', keep = 'first')
+        projects.to_parquet(projects_path(path), index = False)
+        df = df.drop(columns = project_columns[1:])
+    df.to_parquet(path, index = False)
+
+def read_table(path, pairs = True):
+    """
+    read a table written by write_table, metadata tables get their project text and joined attributes back.
+    `pairs` = False skips rebuilding the attribute_pairs column when only the joined attributes are needed.
+    """
+    check_parquet()
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(path)
+    attributes = None
+    if 'attribute_pairs' in table.column_names:
+        # join 'key : value key : value' in arrow, much faster than going through python objects
+        column = table['attribute_pairs'].combine_chunks()
+        joined = pc.binary_join_element_wise(column.values.field('key'), column.values.field('value'), ' : ')
+        attributes = pc.binary_join(pa.ListArray.from_arrays(column.offsets, joined), ' ')
+        attributes = pc.if_else(pc.equal(pc.list_value_length(column), 0), 'NO ATTRIBUTES', attributes)
+        if not pairs:
+            table = table.drop_columns('attribute_pairs')
+
+    df = table.to_pandas()
+    if attributes is not None:
+        df['attributes'] = attributes.to_pandas()
+        if pairs:
+            df['attribute_pairs'] = [[(pair['key'], pair['value']) for pair in pairs] for pairs in df['attribute_pairs']]
+    if is_metadata(df):
+        if os.path.exists(projects_path(path)):
+            df = df.merge(pd.read_parquet(projects_path(path)), on = 'project_id', how = 'left')
+        # same column order as fetch
+        first = [column for column in header + ['attribute_pairs'] if column in df]
+        df = df[first + [column for column in df if column not in first]]
+    return df
@@ -1,13 +1,29 @@
+import io
 import csv
+import time
 import pandas as pd
 from Bio import Entrez
 import os
 import xml.etree.ElementTree as ET
+from http.client import HTTPException
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from llomics.limits import RateLimiter, retry
+from llomics.metrics import metrics
 ########
 
+header = ['project_id','project_title','abstract','protocol','run_id','experiment_id','title','organism','assay_id','attributes',]
+
+# NCBI allows 10 requests/second with an API key, shared by every fetch in the process
+entrez_limiter = RateLimiter(10, period = 1.0)
+
+# network, http and truncated/invalid response errors are worth retrying
+entrez_errors = (OSError, HTTPException, RuntimeError, ValueError, ET.ParseError)
+
 ########
-    
-def fetch(prjid):
+
+def check_entrez():
 
     if os.environ.get('ENTREZ_EMAIL') is None:
         raise ValueError('Please set the environment variable ENTREZ_EMAIL to your email address.')
@@ -17,99 +33,300 @@ def fetch(prjid):
         Entrez.email = os.environ.get('ENTREZ_EMAIL')
         api = os.environ.get('ENTREZ_API_KEY')
 
-    print(f'Fetching {prjid}...')
-    # search by bioproject id and gather sra IDs
-    search = Entrez.read(Entrez.esearch(db = 'sra', term = prjid, retmax = 5000, api_key = api))
-    sra_handle = Entrez.efetch(db = 'sra', id = search['IdList'], rettype = 'full', retmode = 'xml', api_key = api) # changing retmode to xml because there is, it seems, more data in that file
-    # fetch the runinfo for all the ids returned by the search
+    return api
 
-    tree = ET.parse(sra_handle)
-    root = tree.getroot()
+def search(term, api, retries = 3):
+    """
+    esearch against the Entrez history server, returns the total count, WebEnv and query_key
+    """
+    def esearch():
+        entrez_limiter.acquire()
+        return Entrez.read(Entrez.esearch(db = 'sra', term = term, usehistory = 'y', retmax = 0, api_key = api))
 
-    outRows = []
-    for element in root.findall('.//EXPERIMENT_PACKAGE'):
+    result = retry(esearch, retries = retries, retryable = lambda exc: isinstance(exc, entrez_errors))
+    return int(result['Count']), result['WebEnv'], result['QueryKey']
 
-        assay_id = element.find('.//LIBRARY_STRATEGY').text
-        if assay_id.lower() != 'chip-seq':
-            continue
+def search_ids(term, api, retries = 3, page = 10000, **params):
+    """
+    esearch returning the full list of SRA uids for a term, paged `page` ids at a time.
+    Extra Entrez parameters (eg. datetype/mindate/maxdate) are passed through.
+    """
+    ids = []
+    while True:
+        def esearch():
+            entrez_limiter.acquire()
+            return Entrez.read(Entrez.esearch(db = 'sra', term = term, retstart = len(ids), retmax = page, api_key = api, **params))
 
-        header = ['project_id','project_title','abstract','protocol','run_id','experiment_id','title','organism','assay_id','attributes',]
+        result = retry(esearch, retries = retries, retryable = lambda exc: isinstance(exc, entrez_errors))
+        ids.extend(result['IdList'])
+        if not result['IdList'] or len(ids) >= int(result['Count']):
+            return ids
 
-        experiment_id = element.find('.//EXPERIMENT').attrib.get('accession', '')
+def efetch_ids(ids, api, retries = 3):
+    """
+    efetch a list of SRA uids, returns the raw xml
+    """
+    def efetch():
+        entrez_limiter.acquire()
+        handle = Entrez.efetch(db = 'sra', id = ','.join(ids), rettype = 'full', retmode = 'xml', api_key = api)
+        page = handle.read()
+        if isinstance(page, str):
+            page = page.encode('utf-8')
+        return page
 
-        title = element.find('.//SAMPLE/TITLE')
-        if title is not None:
-            title = title.text
-        else:
-            title = 'NO_TITLE'
-
-        project_id = element.find(".//STUDY/IDENTIFIERS/EXTERNAL_ID[@namespace='BioProject']").text
-        project_title = element.find(".//STUDY/DESCRIPTOR/STUDY_TITLE").text 
-        #not saving this but using to fill missing organism
-        taxn = element.find(".//SAMPLE/SAMPLE_NAME/TAXON_ID")
-        if taxn is not None:
-            taxn = taxn.text
-
-        organism = element.find(".//SAMPLE/SAMPLE_NAME/SCIENTIFIC_NAME")
-        if organism is not None:
-            organism = organism.text.replace(' ','_')
-        elif taxn == '4932':
-            organism = 'Saccharomyces cerevisiae'
-        else:
-            organism = 'NO_ORGANISM_DATA'
+    return retry(efetch, retries = retries, retryable = lambda exc: isinstance(exc, entrez_errors))
 
-        run_id = element.find(".//RUN_SET/RUN")
-        if run_id is not None:
-            run_id = run_id.attrib.get('accession','') 
-        else:
-            run_id = "NO_RUNID"
+def efetch_batch(webenv, query_key, start, batch_size, api, retries = 3):
+    """
+    efetch one page of records from the history server, returns the raw xml
+    """
+    def efetch():
+        entrez_limiter.acquire()
+        # changing retmode to xml because there is, it seems, more data in that file
+        handle = Entrez.efetch(db = 'sra', webenv = webenv, query_key = query_key, retstart = start, retmax = batch_size,
+                               rettype = 'full', retmode = 'xml', api_key = api)
+        # read the whole page inside the retry so truncated responses are fetched again
+        page = handle.read()
+        if isinstance(page, str):
+            page = page.encode('utf-8')
+        return page
+
+    return retry(efetch, retries = retries, retryable = lambda exc: isinstance(exc, entrez_errors))
+
+def iter_packages(source):
+    """
+    stream EXPERIMENT_PACKAGE elements out of an efetch xml file/handle with iterparse.
+    Each package is cleared once the caller is done with it so memory stays flat.
+    """
+    context = ET.iterparse(source, events = ('start', 'end'))
+    _, root = next(context)
+    for event, element in context:
+        if event == 'end' and element.tag == 'EXPERIMENT_PACKAGE':
+            yield element
+            element.clear()
+            # also drop the (now empty) package from the package set
+            root.clear()
 
-        abstract = element.find(".//STUDY/DESCRIPTOR/STUDY_ABSTRACT")
-        
-        if abstract is None:
-            abstract = "NO_ABSTRACT"
+def text(element, path, default = None):
+    found = element.find(path)
+    if found is None or found.text is None:
+        return default
+    return found.text
+
+def parse_package(element, assay = 'chip-seq'):
+    """
+    parse a single EXPERIMENT_PACKAGE element into a record dict, using direct child paths.
+    Returns None if the library strategy is not `assay` (None keeps every assay).
+    Attributes are kept as a list of (key, value) pairs, see join_attributes.
+    """
+    assay_id = element.find('EXPERIMENT/DESIGN/LIBRARY_DESCRIPTOR/LIBRARY_STRATEGY').text
+    if assay is not None and assay_id.lower() != assay.lower():
+        return None
+
+    experiment = element.find('EXPERIMENT')
+    study = element.find('STUDY')
+    sample = element.find('SAMPLE')
+
+    experiment_id = experiment.attrib.get('accession', '')
+
+    title = sample.find('TITLE')
+    if title is not None:
+        title = title.text
+    else:
+        title = 'NO_TITLE'
+
+    project_id = study.find("IDENTIFIERS/EXTERNAL_ID[@namespace='BioProject']").text
+    project_title = study.find("DESCRIPTOR/STUDY_TITLE").text
+    #not saving this but using to fill missing organism
+    taxn = text(sample, "SAMPLE_NAME/TAXON_ID")
+
+    organism = sample.find("SAMPLE_NAME/SCIENTIFIC_NAME")
+    if organism is not None:
+        organism = organism.text.replace(' ','_')
+    elif taxn == '4932':
+        organism = 'Saccharomyces cerevisiae'
+    else:
+        organism = 'NO_ORGANISM_DATA'
+
+    run_id = element.find("RUN_SET/RUN")
+    if run_id is not None:
+        run_id = run_id.attrib.get('accession','')
+    else:
+        run_id = "NO_RUNID"
+
+    abstract = study.find("DESCRIPTOR/STUDY_ABSTRACT")
+    if abstract is None:
+        abstract = "NO_ABSTRACT"
+    else:
+        abstract = abstract.text
+
+    protocol = text(experiment, "DESIGN/LIBRARY_DESCRIPTOR/LIBRARY_CONSTRUCTION_PROTOCOL", "NO_PROTOCOL")
+
+    attributes = []
+    for attribute in sample.iterfind('SAMPLE_ATTRIBUTES/SAMPLE_ATTRIBUTE'):
+        key = attribute.find('TAG')
+        if key is not None:
+            key = key.text
         else:
-            abstract = abstract.text
+            key = "NO_KEY"
 
-        protocol = element.find(".//EXPERIMENT/DESIGN/LIBRARY_DESCRIPTOR/LIBRARY_CONSTRUCTION_PROTOCOL")
-        if protocol is None:
-            protocol = "NO_PROTOCOL"
-        elif protocol.text is None:
-            protocol = "NO_PROTOCOL"
+        val = attribute.find('VALUE')
+        if val is not None:
+            val = val.text
         else:
-            protocol = protocol.text
+            val = "NO_VAL"
+        attributes.append((key, val))
 
-        row = [project_id, project_title, abstract,protocol,run_id, experiment_id, title, organism, assay_id]
+    return {'project_id': project_id,
+            'project_title': project_title,
+            'abstract': abstract,
+            'protocol': protocol,
+            'run_id': run_id,
+            'experiment_id': experiment_id,
+            'title': title,
+            'organism': organism,
+            'assay_id': assay_id,
+            'attributes': attributes}
 
-        attributes = []
-        for attribute in element.findall('.//SAMPLE/SAMPLE_ATTRIBUTES/SAMPLE_ATTRIBUTE'):
-            key = attribute.find('TAG')
-            if key is not None:
-                key = key.text
-            else:
-                key = "NO_KEY"
+def join_attributes(attributes):
+    # flat 'key : value key : value' string used in the metadata tables and prompts
+    if not attributes:
+        return 'NO ATTRIBUTES'
+    return ' '.join(' : '.join(attribute) for attribute in attributes)
+
+def records_frame(records):
+    """
+    build a metadata dataframe from parsed records.
+    `attributes` is the joined string used for prompts, `attribute_pairs` keeps the (key, value) pairs.
+    """
+    rows = [[record[column] for column in header[:-1]] + [join_attributes(record['attributes']), record['attributes']] for record in records]
+    return pd.DataFrame(rows, columns = header + ['attribute_pairs'])
+
+def strategy_term(assay):
+    # Entrez indexes library strategies in lower case with spaces, eg. ChIP-Seq -> "chip seq"[Strategy]
+    return f'"{assay.lower().replace("-", " ")}"[Strategy]'
+
+def bulk_query(projects, assay = 'chip-seq', organism = None):
+    """
+    esearch term for the records of several bioprojects, with the assay and organism filters done by Entrez
+    """
+    term = '(' + ' OR '.join(f'{prjid}[BioProject]' for prjid in projects) + ')'
+    if assay is not None:
+        term += ' AND ' + strategy_term(assay)
+    if organism is not None:
+        term += f' AND "{organism}"[Organism]'
+    return term
+
+def iter_records(term,
+                 api,
+                 batch_size = 500,
+                 workers = 3,
+                 retries = 3,
+                 assay = 'chip-seq'):
+    """
+    generator over the parsed records matching an esearch term, returns the number of records found.
+    Records are paged from the Entrez history server `batch_size` at a time, with up to `workers` pages
+    downloading ahead (under the NCBI request limit) while the current page is parsed.
+    """
+    count, webenv, query_key = search(term, api, retries = retries)
+
+    starts = iter(range(0, count, batch_size))
+    fetch_time = 0.0
+    parse_time = 0.0
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        # bounded read-ahead, pages are consumed in order
+        pending = deque(pool.submit(efetch_batch, webenv, query_key, start, batch_size, api, retries) for start in islice(starts, workers))
+        while pending:
+            start_time = time.perf_counter()
+            page = pending.popleft().result()
+            fetch_time += time.perf_counter() - start_time
+            for start in islice(starts, 1):
+                pending.append(pool.submit(efetch_batch, webenv, query_key, start, batch_size, api, retries))
 
-            val = attribute.find('VALUE')
-            if val is not None:
-                val = val.text
+            # parse time excludes time spent by the consumer between records
+            start_time = time.perf_counter()
+            for element in iter_packages(io.BytesIO(page)):
+                record = parse_package(element, assay)
+                if record is not None:
+                    parse_time += time.perf_counter() - start_time
+                    yield record
+                    start_time = time.perf_counter()
+            parse_time += time.perf_counter() - start_time
+            del page
+
+    metrics.timing('fetch', fetch_time)
+    metrics.timing('parse', parse_time)
+    return count
+
+def fetch_iter(prjid,
+               batch_size = 500,
+               workers = 3,
+               retries = 3,
+               assay = 'chip-seq'):
+    """
+    generator over the parsed records of a bioproject, only records of `assay` are downloaded
+    """
+    api = check_entrez()
+
+    print(f'Fetching {prjid}...')
+    # search by bioproject id and keep the sra IDs on the history server
+    term = prjid if assay is None else f'({prjid}) AND {strategy_term(assay)}'
+    count = yield from iter_records(term, api, batch_size = batch_size, workers = workers, retries = retries, assay = assay)
+    print(f'{prjid} fetch complete ({count} records)...')
+
+def fetch_bulk(projects,
+               batch_size = 500,
+               workers = 3,
+               retries = 3,
+               assay = 'chip-seq',
+               organism = None,
+               per_query = 100):
+    """
+    Fetch many bioprojects with one OR'd esearch per `per_query` projects instead of one search per project,
+    with the assay (and optionally organism) filters in the Entrez query so other records are never downloaded.
+    Returns {project id: metadata dataframe}, records are split by their BioProject EXTERNAL_ID.
+    """
+    api = check_entrez()
+    projects = list(dict.fromkeys(projects))
+    records = {prjid: [] for prjid in projects}
+    other = 0
+
+    for i in range(0, len(projects), per_query):
+        group = projects[i:i + per_query]
+        print(f'Fetching {len(group)} projects ({group[0]}...{group[-1]})...')
+        count = 0
+        for record in iter_records(bulk_query(group, assay, organism), api, batch_size = batch_size, workers = workers, retries = retries, assay = assay):
+            count += 1
+            # keep records of this query's projects only
+            if record['project_id'] in group:
+                records[record['project_id']].append(record)
             else:
-                val = "NO_VAL"
-           # attributes.extend([key,val])
-            attributes.append(' : '.join([key,val]))
-        if not attributes:
-            attributes = ['NO','ATTRIBUTES']
-
-#        category = classify(header,row)
-#        header.append('category')
-#        row.append(category)
-        #expText = ' -- '.join([title] + attributes)
-        
-        row.append(' '.join(attributes))
-        #row.append(expText)
-
-        outRows.append(row)
-                 
-    outDF = pd.DataFrame(outRows, columns = header)
-
-    print(f'{prjid} fetch complete...')
-    return(outDF)
\ No newline at end of file
+                other += 1
+        print(f'{len(group)} projects fetch complete ({count} records)...')
+
+    if other:
+        print(f'{other} records from other projects were skipped')
+    return {prjid: records_frame(project_records) for prjid, project_records in records.items()}
+
+def fetch_frames(prjid, chunksize = 10000, **kwargs):
+    """
+    generator of metadata dataframes of up to `chunksize` rows, takes the same arguments as fetch_iter
+    """
+    chunk = []
+    for record in fetch_iter(prjid, **kwargs):
+        chunk.append(record)
+        if len(chunk) == chunksize:
+            yield records_frame(chunk)
+            chunk = []
+    if chunk:
+        yield records_frame(chunk)
+
+def fetch(prjid,
+          batch_size = 500,
+          workers = 3,
+          retries = 3):
+    """
+    fetch all ChIP-seq SRA records for a bioproject as a metadata dataframe
+    """
+    outDF = records_frame(fetch_iter(prjid, batch_size = batch_size, workers = workers, retries = retries))
+    return(outDF)
@@ -0,0 +1,54 @@
+# shared throttling helpers for rate limited services (OpenAI, NCBI Entrez)
+import time
+import random
+import threading
+
+class RateLimiter:
+    """
+    Token bucket shared between worker threads.
+    Allows `rate` units per `period` seconds, `acquire` blocks until `cost` units are free.
+    """
+    def __init__(self, rate, period = 60.0):
+        self.rate = rate
+        self.period = period
+        self.available = float(rate)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, cost = 1):
+        # a single request larger than the whole bucket is let through once the bucket is full
+        cost = min(cost, self.rate)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.available = min(self.rate, self.available + (now - self.updated) * self.rate / self.period)
+                self.updated = now
+                if self.available >= cost:
+                    self.available -= cost
+                    return
+                wait = (cost - self.available) * self.period / self.rate
+            time.sleep(wait)
+
+def retry(fn,
+          retries = 5,
+          backoff = 1.0,
+          max_backoff = 60.0,
+          retryable = lambda exc: True,
+          retry_after = lambda exc: None):
+    """
+    Call `fn` and retry with exponential backoff (plus jitter) when it raises a retryable exception.
+    `retry_after` can return a server suggested wait in seconds which takes precedence over the backoff.
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as exc:
+            if attempt >= retries or not retryable(exc):
+                raise
+            wait = retry_after(exc)
+            if wait is None:
+                wait = min(max_backoff, backoff * 2 ** attempt) * (0.5 + random.random() / 2)
+            print(f'{type(exc).__name__}, retrying in {wait:.1f}s ({attempt + 1}/{retries})...')
+            time.sleep(wait)
+            attempt += 1
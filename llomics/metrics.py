@@ -0,0 +1,179 @@
+# token, cost and latency instrumentation for llomics runs
+import json
+import time
+import threading
+import contextlib
+from functools import lru_cache
+
+# USD per 1M (prompt, completion) tokens, gpt-4o points at the 2024-08-06 snapshot
+prices = {'gpt-4o': (2.50, 10.00),
+          'gpt-4o-2024-05-13': (5.00, 15.00),
+          'gpt-4o-2024-08-06': (2.50, 10.00),
+          'gpt-4o-2024-11-20': (2.50, 10.00),
+          'gpt-4o-mini': (0.15, 0.60),
+          'gpt-4-turbo': (10.00, 30.00),
+          'gpt-4': (30.00, 60.00),
+          'gpt-3.5-turbo': (0.50, 1.50),
+          'gpt-4.1': (2.00, 8.00),
+          'gpt-4.1-mini': (0.40, 1.60),
+          'gpt-4.1-nano': (0.10, 0.40)}
+
+@lru_cache(maxsize = None)
+def encoder(model):
+    """
+    tiktoken encoder for a model, built once per model.
+    None if tiktoken can't load an encoding (eg. offline), token counts are then estimated.
+    """
+    import tiktoken
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding('o200k_base')
+    except Exception:
+        return None
+
+def count_tokens(text, model):
+    tokenizer = encoder(model)
+    if tokenizer is None:
+        # ~4 characters per token for english text
+        return len(text) // 4
+    return len(tokenizer.encode(text, disallowed_special = ()))
+
+def truncate_tokens(text, max_tokens, model = 'gpt-4o'):
+    """
+    first `max_tokens` tokens of a text, marked with [...] when it was cut
+    """
+    tokenizer = encoder(model)
+    if tokenizer is None:
+        if len(text) <= max_tokens * 4:
+            return text
+        return text[:max_tokens * 4] + ' [...]'
+    tokens = tokenizer.encode(text, disallowed_special = ())
+    if len(tokens) <= max_tokens:
+        return text
+    return tokenizer.decode(tokens[:max_tokens]) + ' [...]'
+
+def request_tokens(request):
+    """
+    prompt tokens of a chat completion request, messages plus any function schema
+    """
+    model = request['model']
+    tokens = sum(count_tokens(message.get('content') or '', model) for message in request['messages'])
+    if 'functions' in request:
+        tokens += count_tokens(json.dumps(request['functions']), model)
+    return tokens
+
+def price(model):
+    """
+    (prompt, completion) price per 1M tokens, dated model snapshots fall back to their base model
+    """
+    if model in prices:
+        return prices[model]
+    for name in sorted(prices, key = len, reverse = True):
+        if model.startswith(name):
+            return prices[name]
+    return None
+
+def cost(model, prompt_tokens, completion_tokens = 0):
+    model_price = price(model)
+    if model_price is None:
+        return None
+    return (prompt_tokens * model_price[0] + completion_tokens * model_price[1]) / 1000000
+
+def dollars(amount):
+    return 'unknown cost' if amount is None else f'~${amount:.4f}'
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+class Metrics:
+    """
+    Thread safe collector of LLM calls (tokens, latency), stage timings and counters for a run.
+    Stage times are cumulative over threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = []
+            self.stages = {}
+            self.counters = {}
+            self.estimate = None
+
+    def record_call(self, kind, model, response, seconds, cached = False):
+        usage = getattr(response, 'usage', None)
+        with self.lock:
+            self.calls.append({'kind': kind,
+                               'model': model,
+                               'prompt_tokens': usage.prompt_tokens if usage else 0,
+                               'completion_tokens': usage.completion_tokens if usage else 0,
+                               'seconds': seconds,
+                               'cached': cached})
+
+    def timing(self, name, seconds):
+        with self.lock:
+            total, count = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, count + 1)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, time.perf_counter() - start)
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        """
+        structured summary of the run, LLM calls are grouped by kind and model
+        """
+        with self.lock:
+            calls = list(self.calls)
+            stages = dict(self.stages)
+            counters = dict(self.counters)
+            estimate = self.estimate
+
+        groups = {}
+        for call in calls:
+            groups.setdefault((call['kind'], call['model']), []).append(call)
+
+        summary = []
+        for (kind, model), group in groups.items():
+            sent = [call for call in group if not call['cached']]
+            prompt_tokens = sum(call['prompt_tokens'] for call in sent)
+            completion_tokens = sum(call['completion_tokens'] for call in sent)
+            latencies = [call['seconds'] for call in sent]
+            summary.append({'kind': kind,
+                            'model': model,
+                            'requests': len(sent),
+                            'cached': len(group) - len(sent),
+                            'prompt_tokens': prompt_tokens,
+                            'completion_tokens': completion_tokens,
+                            'cost': cost(model, prompt_tokens, completion_tokens),
+                            'latency_p50': percentile(latencies, 50),
+                            'latency_p95': percentile(latencies, 95),
+                            'latency_max': max(latencies) if latencies else None})
+
+        costs = [group['cost'] for group in summary]
+        return {'calls': summary,
+                'total_cost': sum(costs) if None not in costs else None,
+                'stages': {name: {'seconds': total, 'count': count} for name, (total, count) in stages.items()},
+                'counters': counters,
+                'estimate': estimate}
+
+    def to_json(self, path):
+        with open(path, 'w') as out:
+            json.dump(self.report(), out, indent = 2)
+
+# collector shared by the whole package
+metrics = Metrics()
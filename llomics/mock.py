@@ -0,0 +1,181 @@
+# synthetic SRA metadata and a mock OpenAI client for offline testing and benchmarking
+import re
+import json
+import time
+import random
+import threading
+from xml.sax.saxutils import escape
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+targets = ['H3K4me3', 'H3K36me3', 'H3K79me3', 'H3K27ac', 'Set1', 'Set2', 'Rpb1']
+genotypes = ['WT', 'WT', 'set2Δ', 'H3-K4R', 'dot1Δ']
+conditions = ['', '', 'heat shock', 'rapamycin']
+time_points = ['', '0 min', '30 min', '60 min']
+
+def synthetic_package(project, experiment, seed = 0, assay = 'ChIP-Seq'):
+    """
+    one EXPERIMENT_PACKAGE with the same layout as an SRA efetch record
+    """
+    rng = random.Random(f'{project}-{experiment}-{seed}')
+    control = rng.random() < 0.2
+    target = rng.choice(['Input', 'Input', 'IgG']) if control else rng.choice(targets)
+    genotype = rng.choice(genotypes)
+    condition = rng.choice(conditions)
+    time_point = rng.choice(time_points)
+    replicate = rng.randint(1, 3)
+    title = ' '.join(part for part in [genotype, target, condition, time_point, f'rep{replicate}'] if part)
+    attributes = [('strain', 'BY4741'), ('genotype', genotype), ('chip antibody', 'none' if target == 'Input' else f'anti-{target}'),
+                  ('treatment', condition or 'none'), ('time', time_point or 'none'), ('replicate', str(replicate))]
+    attributes = ''.join(f'<SAMPLE_ATTRIBUTE><TAG>{escape(key)}</TAG><VALUE>{escape(value)}</VALUE></SAMPLE_ATTRIBUTE>' for key, value in attributes)
+    abstract = f'Synthetic study {project} of chromatin changes in mutants and stress conditions. ' * 5
+    protocol = 'Chromatin was crosslinked with 1% formaldehyde, sonicated and immunoprecipitated. ' * 5
+
+    return f"""<EXPERIMENT_PACKAGE>
+<EXPERIMENT accession="SRX{experiment}" alias="{project}_{experiment}"><IDENTIFIERS><PRIMARY_ID>SRX{experiment}</PRIMARY_ID></IDENTIFIERS><TITLE>{escape(title)}</TITLE><STUDY_REF accession="SRP{project[5:]}"/><DESIGN><DESIGN_DESCRIPTION/><SAMPLE_DESCRIPTOR accession="SRS{experiment}"/><LIBRARY_DESCRIPTOR><LIBRARY_NAME>{escape(title)}</LIBRARY_NAME><LIBRARY_STRATEGY>{assay}</LIBRARY_STRATEGY><LIBRARY_SOURCE>GENOMIC</LIBRARY_SOURCE><LIBRARY_SELECTION>ChIP</LIBRARY_SELECTION><LIBRARY_LAYOUT><SINGLE/></LIBRARY_LAYOUT><LIBRARY_CONSTRUCTION_PROTOCOL>{protocol}</LIBRARY_CONSTRUCTION_PROTOCOL></LIBRARY_DESCRIPTOR></DESIGN><PLATFORM><ILLUMINA><INSTRUMENT_MODEL>Illumina NextSeq 500</INSTRUMENT_MODEL></ILLUMINA></PLATFORM></EXPERIMENT>
+<SUBMISSION accession="SRA{project[5:]}" center_name="GEO"/>
+<Organization type="center"><Name>GEO</Name></Organization>
+<STUDY accession="SRP{project[5:]}"><IDENTIFIERS><PRIMARY_ID>SRP{project[5:]}</PRIMARY_ID><EXTERNAL_ID namespace="BioProject">{project}</EXTERNAL_ID></IDENTIFIERS><DESCRIPTOR><STUDY_TITLE>Synthetic study {project}</STUDY_TITLE><STUDY_TYPE existing_study_type="Other"/><STUDY_ABSTRACT>{abstract}</STUDY_ABSTRACT></DESCRIPTOR></STUDY>
+<SAMPLE accession="SRS{experiment}"><IDENTIFIERS><PRIMARY_ID>SRS{experiment}</PRIMARY_ID></IDENTIFIERS><TITLE>{escape(title)}</TITLE><SAMPLE_NAME><TAXON_ID>4932</TAXON_ID><SCIENTIFIC_NAME>Saccharomyces cerevisiae</SCIENTIFIC_NAME></SAMPLE_NAME><SAMPLE_ATTRIBUTES>{attributes}</SAMPLE_ATTRIBUTES></SAMPLE>
+<RUN_SET><RUN accession="SRR{experiment}" total_spots="1000000"><IDENTIFIERS><PRIMARY_ID>SRR{experiment}</PRIMARY_ID></IDENTIFIERS><EXPERIMENT_REF accession="SRX{experiment}"/></RUN></RUN_SET>
+</EXPERIMENT_PACKAGE>
+"""
+
+def synthetic_xml(n_projects = 1, n_experiments = 50, seed = 0, other_assays = 0.0):
+    """
+    efetch style xml for `n_projects` projects of `n_experiments` experiments each.
+    A fraction `other_assays` of the packages are RNA-Seq instead of ChIP-Seq.
+    """
+    rng = random.Random(seed)
+    packages = []
+    for p in range(n_projects):
+        project = f'PRJNA{900000 + p}'
+        for e in range(n_experiments):
+            assay = 'RNA-Seq' if rng.random() < other_assays else 'ChIP-Seq'
+            packages.append(synthetic_package(project, p * n_experiments + e, seed, assay))
+
+    return ('<?xml version="1.0" encoding="UTF-8" ?>\n<EXPERIMENT_PACKAGE_SET>\n' + ''.join(packages) + '</EXPERIMENT_PACKAGE_SET>\n').encode('utf-8')
+
+def mock_annotation(experiment_id, title):
+    """
+    keyword based stand in for an LLM annotation of a synthetic experiment
+    """
+    words = title.lower()
+    time_point = re.search(r'\d+ ?min', words)
+    mutation = re.search(r'\S+-k\d+r', words)
+    deletion = re.search(r'(\S+)δ', words)
+    stress = re.search(r'heat shock|rapamycin', words)
+    target = next((target for target in targets if target.lower() in words.split()), '')
+
+    return {'experiment_id': experiment_id,
+            'exp_title': title,
+            'gene_mutation': mutation is not None,
+            'gene_deletion': deletion is not None,
+            'protein_depletion': False,
+            'stress_condition': stress is not None,
+            'time_series': time_point is not None,
+            'chip_input': 'input' in words,
+            'antibody_control': 'igg' in words,
+            'chip_target': 'None' if 'input' in words else target,
+            'mutation': mutation.group(0) if mutation else '',
+            'deletion': f'Δ{deletion.group(1)}' if deletion else '',
+            'depletion': '',
+            'stress': stress.group(0) if stress else '',
+            'time_point': time_point.group(0) if time_point else ''}
+
+def mock_response(request):
+    """
+    chat completion (as a dict) answering a summarize or jsonOut request
+    """
+    prompt = request['messages'][-1]['content']
+    message = {'role': 'assistant', 'content': None}
+    function_call = request.get('function_call')
+    if function_call is None:
+        message['content'] = 'Summary: synthetic ChIP-seq project with inputs, IgG controls, deletions, mutations, stress and time points.'
+    else:
+        experiments = re.findall(r"Experiment ID: (\S+)\nExperiment Title: '(.*)'", prompt)
+        # compact prompts, a table with one 'id | title | values' line per experiment
+        table = prompt.split('Experiment ID | Experiment Title |', 1)
+        if len(table) == 2:
+            rows = [line.split(' | ') for line in table[1].split('\n')[1:]]
+            experiments += [(row[0], row[1]) for row in rows if len(row) > 1]
+        annotations = [mock_annotation(experiment_id, title) for experiment_id, title in experiments]
+        if function_call['name'] == 'json_output':
+            arguments = annotations[0]
+        else:
+            arguments = {'experimentMeta': annotations}
+        message['function_call'] = {'name': function_call['name'], 'arguments': json.dumps(arguments, ensure_ascii = False)}
+
+    prompt_tokens = sum(len(m.get('content') or '') for m in request['messages']) // 4
+    completion_tokens = len(message['content'] or message['function_call']['arguments']) // 4
+    return {'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': request['model'],
+            'choices': [{'index': i, 'finish_reason': 'stop', 'message': message} for i in range(request.get('n') or 1)],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}}
+
+def batch_results(requests_path, results_path):
+    """
+    fake Batch API output file answering every request of a batch input file with mock_response
+    """
+    with open(requests_path, encoding = 'utf-8') as requests, open(results_path, 'w', encoding = 'utf-8') as results:
+        for i, line in enumerate(requests):
+            request = json.loads(line)
+            result = {'id': f'batch_req_{i}', 'custom_id': request['custom_id'], 'error': None,
+                      'response': {'status_code': 200, 'request_id': f'req_{i}', 'body': mock_response(request['body'])}}
+            results.write(json.dumps(result, ensure_ascii = False) + '\n')
+
+class MockClient:
+    """
+    Drop in replacement for OpenAI() that answers chat.completions.create with mock_response
+    after sleeping `latency` (+ up to `jitter`) seconds. Call latencies are recorded in `latencies`.
+    """
+    def __init__(self, latency = 0.0, jitter = 0.0, seed = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.chat = self
+        self.completions = self
+
+    def create(self, **request):
+        from openai.types.chat import ChatCompletion
+        start = time.perf_counter()
+        with self.lock:
+            delay = self.latency + self.rng.random() * self.jitter
+        time.sleep(delay)
+        response = ChatCompletion.model_validate(mock_response(request))
+        with self.lock:
+            self.latencies.append(time.perf_counter() - start)
+        return response
+
+def serve(port = 8000, latency = 0.0, jitter = 0.0):
+    """
+    local OpenAI compatible server on /v1/chat/completions backed by MockClient.
+    Point llomics at it with OPENAI_BASE_URL=http://localhost:{port}/v1
+    """
+    client = MockClient(latency, jitter)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            body = client.create(**request).model_dump_json().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('localhost', port), Handler)
+    print(f'mock OpenAI server on http://localhost:{port}/v1')
+    server.serve_forever()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = 'run a mock OpenAI compatible server')
+    parser.add_argument('--port', type = int, default = 8000)
+    parser.add_argument('--latency', type = float, default = 0.0)
+    parser.add_argument('--jitter', type = float, default = 0.0)
+    args = parser.parse_args()
+    serve(args.port, args.latency, args.jitter)
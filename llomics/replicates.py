@@ -0,0 +1,44 @@
+# group replicate experiments so only one of each group is sent to the LLM
+import re
+import pandas as pd
+
+# replicate words in titles and attribute values, eg. rep1, Rep_2, R3, replicate 1, biological replicate 2, BR1
+replicate_tokens = re.compile(r'(?<![a-z0-9])((bio(logical)?|tech(nical)?)[ _-]?)?(rep(licate)?|r|br|tr)[ _-]?\d{1,2}(?![a-z0-9])', re.I)
+# replicate attributes, eg. 'replicate : 1' or 'biological replicate : rep2'
+replicate_attributes = re.compile(r'(?<![a-z0-9])((biological|technical) )?replicate[^:]*? : \S+', re.I)
+
+def normalize(text):
+    """
+    lower case text without replicate tokens or punctuation
+    """
+    text = replicate_attributes.sub(' ', str(text))
+    text = replicate_tokens.sub(' ', text)
+    return ' '.join(re.split(r'[\s_,;:/()\[\]-]+', text.lower())).strip()
+
+def replicate_groups(expMeta):
+    """
+    Group the experiments of a project that are identical after removing replicate tokens from title and attributes.
+    Returns (groups, conflicts): groups maps each representative (first experiment of the group) to its members,
+    conflicts are experiments whose normalized title matches another experiment with different attributes.
+    """
+    exps = expMeta.drop_duplicates(subset = 'experiment_id', keep = 'first')
+    keys = pd.DataFrame({'experiment_id': exps['experiment_id'],
+                         'title': exps['title'].map(normalize),
+                         'attributes': exps['attributes'].map(normalize)})
+
+    groups = {}
+    for (title, attributes), group in keys.groupby(['title','attributes'], sort = False):
+        members = list(group['experiment_id'])
+        groups[members[0]] = members
+
+    # same title, different attributes: either not replicates or a replicate label we don't recognise
+    split = keys.groupby('title')['attributes'].transform('nunique') > 1
+    conflicts = set(keys.loc[split & (keys['title'] != ''), 'experiment_id'])
+
+    return groups, conflicts
+
+def fan_out(annotation, members, titles):
+    """
+    copies of a representative's annotation for every member of its group
+    """
+    return {member: annotation.model_copy(update = {'experiment_id': member, 'exp_title': titles[member]}) for member in members}
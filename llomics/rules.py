@@ -0,0 +1,89 @@
+# deterministic fast path, annotates experiments that are obvious from the title without an LLM call
+import re
+from llomics.validate import title_patterns, title_tokens
+
+def histone(token):
+    """
+    Brno notation for a histone mark token, eg. h3k4me3 -> H3K4me3
+    """
+    match = title_patterns['histone'].fullmatch(token)
+    return match.group(1).upper() + match.group(2).upper() + match.group(3).lower()
+
+# token rules, (pattern, fields) the fields can be a function of the token.
+# Extend this list to teach the fast path new vocabulary.
+rules = [(title_patterns['wt'], {}),
+         (title_patterns['replicate'], {}),
+         (title_patterns['chip'], {}),
+         (title_patterns['input'], {'chip_input': True}),
+         (title_patterns['igg'], {'antibody_control': True}),
+         (title_patterns['histone'], lambda token: {'chip_target': histone(token)})]
+
+# attributes that point to a perturbation or time series, and values that don't
+signal_keys = re.compile(r'time|treatment|treated|condition|stress|drug|genotype|mutation|deletion|depletion|phase|induction|auxin|temperature', re.I)
+null_values = {'none', 'na', 'n/a', '-', 'no', 'untreated', 'mock', 'control', 'wt', 'wild-type', 'wildtype', 'wild type', 'unknown', 'not treated', 'no treatment'}
+null_words = {'none', 'na', 'n/a', '-', 'no', 'not', 'untreated', 'mock', 'control', 'wt', 'wild-type', 'wildtype', 'wild', 'type', 'unknown'}
+
+def split_attributes(attributes):
+    """
+    (key, value) pairs of an attribute string joined by fetch.join_attributes.
+    Keys aren't delimited so the two words before each ' : ' are taken as the key and the last word
+    of the value before it is left out, a multi-word key can only add words to the value it follows.
+    """
+    parts = str(attributes).split(' : ')
+    pairs = []
+    for i in range(1, len(parts)):
+        key = ' '.join(parts[i - 1].split()[-2:])
+        value = parts[i].split()
+        pairs.append((key, ' '.join(value if i == len(parts) - 1 else value[:-1])))
+    return pairs
+
+def perturbed(attributes):
+    """
+    True if any perturbation or time attribute has a real value, every word of the value is checked.
+    `attributes` are (key, value) pairs or a joined attribute string.
+    """
+    pairs = attributes if isinstance(attributes, list) else split_attributes(attributes)
+    for key, value in pairs:
+        value = str(value).lower().strip()
+        if not signal_keys.search(str(key)) or not value or value in null_values:
+            continue
+        if any(word not in null_words for word in re.split(r'[\s,;/()]+', value) if word):
+            return True
+    return False
+
+def classify(experiment_id, title, attributes, rules = rules):
+    """
+    experiment_model fields for an experiment whose title is made only of known tokens and whose attributes
+    (pairs or joined string, see perturbed) don't mention a perturbation or time point, None if the experiment needs the LLM.
+    The experiment must come out as an input, an antibody control or a single target.
+    """
+    if perturbed(attributes):
+        return None
+
+    fields = {}
+    for token in title_tokens(title):
+        for pattern, update in rules:
+            if pattern.fullmatch(token):
+                update = update(token) if callable(update) else update
+                break
+        else:
+            return None
+
+        for key, value in update.items():
+            if fields.setdefault(key, value) != value:
+                return None
+
+    controls = fields.get('chip_input', False) + fields.get('antibody_control', False)
+    if controls + ('chip_target' in fields) != 1:
+        return None
+
+    return dict({'experiment_id': experiment_id,
+                 'exp_title': title,
+                 'gene_mutation': False,
+                 'gene_deletion': False,
+                 'protein_depletion': False,
+                 'stress_condition': False,
+                 'time_series': False,
+                 'chip_input': False,
+                 'antibody_control': False,
+                 'chip_target': ''}, **fields)
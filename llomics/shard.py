@@ -0,0 +1,151 @@
+# sharded annotation of large bioproject manifests, each shard is an independent annotate() run
+# that can go to its own process or node, merge() combines the parts and validates/tags them
+# llomics shard run manifest.txt --index 0 --count 8 -m gpt-4o-mini -d parts
+# llomics shard merge parts -o annotated.csv
+import os
+import re
+import glob
+import hashlib
+import pandas as pd
+from llomics.tag import finalize, read_output, write_output
+
+part_pattern = re.compile(r'part-(\d+)-of-(\d+)\.(csv|parquet)$')
+
+def read_manifest(path):
+    """
+    bioproject ids of a manifest in input order, without duplicates:
+    a text file with one id per line (blank lines and # comments skipped),
+    a csv with a project_id column, or a metadata .parquet written by llomics fetch
+    """
+    if path.endswith('.parquet'):
+        from llomics.columnar import read_table
+        projects = read_table(path, pairs = False)['project_id'].astype(str)
+    elif path.endswith('.csv'):
+        projects = pd.read_csv(path, usecols = ['project_id'], dtype = str)['project_id']
+    else:
+        with open(path) as manifest:
+            projects = [line.split('#')[0].strip() for line in manifest]
+    return list(dict.fromkeys(project for project in projects if project))
+
+def shard_of(project_id, count):
+    """
+    shard index of a project, a hash of the id so it doesn't depend on the manifest order or the machine
+    """
+    return int.from_bytes(hashlib.sha1(project_id.encode('utf-8')).digest()[:8], 'big') % count
+
+def shard(projects, index, count):
+    """
+    the projects of shard `index` out of `count`
+    """
+    if not 0 <= index < count:
+        raise ValueError(f"shard index must be between 0 and {count - 1}, got {index}")
+    return [project for project in projects if shard_of(project, count) == index]
+
+def part_path(outDir, index, count, format = 'csv'):
+    return os.path.join(outDir, f'part-{index:05d}-of-{count:05d}.{format}')
+
+def write_part(df, path):
+    # written under a temporary name and renamed, a part that exists is complete
+    root, ext = os.path.splitext(path)
+    tmp = f'{root}.tmp{ext}'
+    if ext == '.parquet':
+        from llomics.columnar import write_table
+        write_table(df, tmp)
+    else:
+        df.to_csv(tmp, index = False)
+    os.replace(tmp, path)
+
+def run_shard(manifest, index, count, model, outDir, format = 'csv', overwrite = False, **kwargs):
+    """
+    Annotate shard `index` of `count` of a manifest (path or list of project ids) and write it to
+    <outDir>/part-<index>-of-<count>.<format>. The other arguments go to annotate(), validation and tagging are left to merge().
+    Every shard keeps its own checkpoint next to its part, a shard that is run again resumes from it,
+    and a shard whose part already exists is skipped unless `overwrite`.
+    rpm/tpm limits apply to each shard separately, divide the account limits by the number of shards running at once.
+    """
+    from llomics.annotate import annotate
+
+    path = part_path(outDir, index, count, format)
+    if os.path.exists(path) and not overwrite:
+        print(f'{path} already exists, skipping shard {index}')
+        return read_output(path)
+    os.makedirs(outDir, exist_ok = True)
+
+    input = read_manifest(manifest) if isinstance(manifest, str) else list(manifest)
+    projects = shard(input, index, count)
+    print(f'shard {index} of {count}: {len(projects)} of {len(input)} projects')
+    if isinstance(manifest, str) and manifest.endswith('.parquet'):
+        # annotate the shard's rows of the metadata table instead of fetching them again
+        from llomics.columnar import read_table
+        meta = read_table(manifest)
+        projects = meta[meta['project_id'].isin(projects)]
+
+    kwargs.setdefault('checkpoint', f'{os.path.splitext(path)[0]}.checkpoint.jsonl')
+    kwargs.setdefault('resume', isinstance(kwargs['checkpoint'], str) and os.path.exists(kwargs['checkpoint']))
+    if len(projects):
+        outdf = annotate(projects, model, validate = False, tag = False, **kwargs)
+    else:
+        outdf = pd.DataFrame()
+    write_part(outdf, path)
+    print(f'shard {index}: {len(outdf)} experiments written to {path}')
+
+    return outdf
+
+def run_local(manifest, count, model, outDir, processes = None, format = 'csv', **kwargs):
+    """
+    run all `count` shards of a manifest in `processes` local processes (default one per shard),
+    returns the part paths for merge()
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers = processes or count) as pool:
+        futures = [pool.submit(run_shard, manifest, index, count, model, outDir, format, **kwargs) for index in range(count)]
+        for future in futures:
+            future.result()
+
+    return [part_path(outDir, index, count, format) for index in range(count)]
+
+def find_parts(outDir):
+    """
+    part files of a shard run, in shard order; raises if shards are missing or the parts come from runs with different counts
+    """
+    parts = {}
+    for path in glob.glob(os.path.join(outDir, 'part-*')):
+        match = part_pattern.search(os.path.basename(path))
+        if match:
+            parts[(int(match.group(2)), int(match.group(1)))] = path
+    counts = {count for count, index in parts}
+    if not parts:
+        raise ValueError(f"no part files in {outDir}")
+    if len(counts) > 1:
+        raise ValueError(f"parts of runs with different shard counts {sorted(counts)} in {outDir}")
+    count = counts.pop()
+    missing = [index for index in range(count) if (count, index) not in parts]
+    if missing:
+        raise ValueError(f"{len(missing)} of {count} shards missing in {outDir}: {missing}")
+
+    return [parts[(count, index)] for index in range(count)]
+
+def merge(parts, outFile = None, validate = True, tag = True, manifest = None):
+    """
+    Combine the parts of a shard run (a directory or list of part files) into one annotation table
+    and run the validate checks, tagExps and setControl on it, grouped by project.
+    With a `manifest` the projects are put back in manifest order.
+    """
+    if isinstance(parts, str):
+        parts = find_parts(parts)
+    frames = [df for df in (read_output(path) for path in parts) if len(df)]
+    outdf = pd.concat(frames, ignore_index = True) if frames else pd.DataFrame()
+
+    if manifest is not None and len(outdf):
+        order = {project: i for i, project in enumerate(read_manifest(manifest) if isinstance(manifest, str) else manifest)}
+        outdf = outdf.iloc[outdf['project_id'].map(order).fillna(len(order)).argsort(kind = 'stable')].reset_index(drop = True)
+
+    if len(outdf):
+        outdf = finalize(outdf, validate, tag)
+    print(f'{len(outdf)} experiments of {outdf["project_id"].nunique() if len(outdf) else 0} projects merged from {len(parts)} parts')
+
+    if outFile is not None:
+        write_output(outdf, outFile, tag)
+
+    return outdf
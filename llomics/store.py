@@ -0,0 +1,157 @@
+# local store of raw SRA EXPERIMENT_PACKAGE records with incremental refresh per bioproject
+import io
+import zlib
+import time
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from llomics.fetch import check_entrez, search_ids, efetch_ids, iter_packages, parse_package, records_frame
+
+class MetaStore:
+    """
+    SQLite store of compressed EXPERIMENT_PACKAGE xml, indexed by project, experiment and every run accession.
+    Every assay is stored, filtering happens when records are read back.
+    `refresh` only efetches uids that are new (or modified since the last sync) for a bioproject.
+    The connection is shared by the fetch threads of annotate_iter, every query holds the lock.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS packages (experiment_id TEXT PRIMARY KEY, project_id TEXT, run_id TEXT, xml BLOB, updated REAL);
+            CREATE INDEX IF NOT EXISTS packages_project ON packages (project_id);
+            CREATE INDEX IF NOT EXISTS packages_run ON packages (run_id);
+            CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, experiment_id TEXT);
+            CREATE TABLE IF NOT EXISTS uids (project_id TEXT, uid TEXT, PRIMARY KEY (project_id, uid));
+            CREATE TABLE IF NOT EXISTS projects (project_id TEXT PRIMARY KEY, synced TEXT);
+        """)
+        self.db.commit()
+
+    def projects(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT project_id FROM projects ORDER BY project_id')]
+
+    def synced(self, prjid):
+        with self.lock:
+            row = self.db.execute('SELECT synced FROM projects WHERE project_id = ?', (prjid,)).fetchone()
+        return row[0] if row else None
+
+    def uids(self, prjid):
+        with self.lock:
+            return {row[0] for row in self.db.execute('SELECT uid FROM uids WHERE project_id = ?', (prjid,))}
+
+    @staticmethod
+    def rows(xml):
+        """
+        (package rows, run rows) for every package in an efetch xml page
+        """
+        packages = []
+        runs = []
+        for element in iter_packages(io.BytesIO(xml)):
+            record = parse_package(element, assay = None)
+            packages.append((record['experiment_id'], record['project_id'], record['run_id'],
+                             zlib.compress(ET.tostring(element)), time.time()))
+            runs += [(run.attrib['accession'], record['experiment_id']) for run in element.findall('RUN_SET/RUN') if run.attrib.get('accession')]
+        return packages, runs
+
+    def _insert(self, packages, runs):
+        # caller holds the lock and commits
+        self.db.executemany('INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?)', packages)
+        self.db.executemany('INSERT OR REPLACE INTO runs VALUES (?, ?)', runs)
+
+    def add(self, xml):
+        """
+        store every package in an efetch xml page, returns the number of packages stored
+        """
+        packages, runs = self.rows(xml)
+        with self.lock:
+            self._insert(packages, runs)
+            self.db.commit()
+        return len(packages)
+
+    def refresh(self,
+                prjid,
+                batch_size = 500,
+                workers = 3,
+                retries = 3):
+        """
+        sync a bioproject with the SRA, only new or updated uids are fetched.
+        Returns the number of uids that were fetched.
+        """
+        api = check_entrez()
+        ids = set(search_ids(prjid, api, retries = retries))
+        known = self.uids(prjid)
+        synced = self.synced(prjid)
+
+        withdrawn = bool(known - ids)
+        if withdrawn:
+            # records were withdrawn, uids aren't mapped to experiments so refetch the whole project
+            print(f'{prjid}: {len(known - ids)} records withdrawn, refetching project...')
+            stale = ids
+        else:
+            stale = ids - known
+            if synced is not None and known:
+                stale |= ids & set(search_ids(prjid, api, retries = retries, datetype = 'mdat', mindate = synced, maxdate = '3000'))
+
+        print(f'{prjid}: {len(ids)} records, fetching {len(stale)} new or updated...')
+        stale = sorted(stale)
+        batches = [stale[i:i + batch_size] for i in range(0, len(stale), batch_size)]
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            pages = [self.rows(page) for page in pool.map(lambda batch: efetch_ids(batch, api, retries = retries), batches)]
+
+        # the project is replaced in one transaction, a failed refresh leaves the previous sync intact
+        with self.lock:
+            if withdrawn:
+                self.db.execute('DELETE FROM runs WHERE experiment_id IN (SELECT experiment_id FROM packages WHERE project_id = ?)', (prjid,))
+                self.db.execute('DELETE FROM packages WHERE project_id = ?', (prjid,))
+                self.db.execute('DELETE FROM uids WHERE project_id = ?', (prjid,))
+            for packages, runs in pages:
+                self._insert(packages, runs)
+            self.db.executemany('INSERT OR IGNORE INTO uids VALUES (?, ?)', [(prjid, uid) for uid in ids])
+            self.db.execute('INSERT OR REPLACE INTO projects VALUES (?, ?)', (prjid, time.strftime('%Y/%m/%d')))
+            self.db.commit()
+
+        return len(stale)
+
+    def missing(self, prjids):
+        """
+        the bioprojects of `prjids` without any stored record
+        """
+        with self.lock:
+            stored = {row[0] for row in self.db.execute('SELECT DISTINCT project_id FROM packages')}
+        return [prjid for prjid in prjids if prjid not in stored]
+
+    def records(self, prjid, assay = 'chip-seq'):
+        """
+        generator of parsed records for a bioproject, same format as fetch.fetch_iter
+        """
+        # rows are read under the lock, parsed outside it
+        with self.lock:
+            rows = self.db.execute('SELECT xml FROM packages WHERE project_id = ? ORDER BY experiment_id', (prjid,)).fetchall()
+        for (xml,) in rows:
+            record = parse_package(ET.fromstring(zlib.decompress(xml)), assay)
+            if record is not None:
+                yield record
+
+    def lookup(self, accession, assay = None):
+        """
+        parsed record for an experiment or run accession, None if it isn't stored
+        """
+        with self.lock:
+            row = self.db.execute('SELECT xml FROM packages WHERE experiment_id = ? OR run_id = ? OR experiment_id IN (SELECT experiment_id FROM runs WHERE run_id = ?)',
+                                  (accession, accession, accession)).fetchone()
+        if row is None:
+            return None
+        return parse_package(ET.fromstring(zlib.decompress(row[0])), assay)
+
+    def frame(self, prjid, assay = 'chip-seq'):
+        """
+        metadata dataframe for a bioproject, same format as fetch.fetch
+        """
+        return records_frame(self.records(prjid, assay))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
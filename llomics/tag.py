@@ -0,0 +1,142 @@
+# sample tags and control matching for annotation tables, needs only pandas/numpy
+import numpy as np
+import pandas as pd
+from llomics.validate import bool_check, project_checks
+from llomics.metrics import metrics
+
+# perturbation type and the variable holding the perturbation, in order of precedence
+perturbations = {'gene_mutation':'mutation',
+                 'gene_deletion':'deletion',
+                 'protein_depletion':'depletion',
+                 'stress_condition':'stress'}
+
+def tagExps(annotated_exps):
+    """
+    build the sample tag and perturbation type for every experiment, column-wise
+    """
+    timepoint = annotated_exps['time_point'].map(str).str.replace(' ','_')
+    target = annotated_exps['chip_target'].where(annotated_exps['chip_input'] != True, 'Input').map(str)
+    time_series = annotated_exps['time_series'].astype(bool)
+
+    # the first true perturbation flag sets the perturbation type
+    flags = [annotated_exps[pertype].astype(bool) for pertype in perturbations]
+    perturbed = annotated_exps.loc[:, 'gene_mutation':'stress_condition'].astype(bool).any(axis = 1)
+    pertype = pd.Series(np.select(flags, list(perturbations), 'none'), index = annotated_exps.index)
+    per = pd.Series(np.select(flags, [annotated_exps[var].map(str) for var in perturbations.values()], ''), index = annotated_exps.index)
+
+    sample = np.select([perturbed & time_series, perturbed, time_series],
+                       [target + '-' + per + '-' + pertype + '-' + timepoint,
+                        target + '-' + per + '-' + pertype,
+                        target + '-WT-' + timepoint],
+                       target + '-WT')
+
+    annotated_exps['sample'] = sample
+    annotated_exps['perturbation'] = pertype.where(perturbed, 'none')
+
+    return annotated_exps
+
+def lower(values):
+    # lower case strings, missing values stay missing (all-missing columns read from csv are float)
+    return values.fillna('').astype(str).str.lower().where(values.notna())
+
+def setControl(annotated):
+    """
+    Match every experiment to a control from the same project, for all projects at once.
+    Controls are the project's inputs, or its antibody controls if there are no inputs.
+    WT experiments match unperturbed controls, perturbed experiments match controls with the same
+    (case-insensitive) perturbation, time series experiments also need the same time point.
+    Matching is a merge on those keys, the first matching control in table order wins.
+    """
+    df = annotated.reset_index(drop = True)
+    df['row'] = df.index
+
+    inputs = df['chip_input'] == True
+    antibody = df['antibody_control'] == True
+    has_input = inputs.groupby(df['project_id']).transform('any')
+    has_antibody = antibody.groupby(df['project_id']).transform('any')
+    is_control = inputs | (~has_input & antibody)
+
+    # keys for the experiments, perturbed experiments use the variable of their first true perturbation flag
+    exps = df[~is_control & (has_input | has_antibody)]
+    wt = exps['sample'].str.contains('WT', regex = False)
+    kind = pd.Series(np.select([wt] + [exps[flag] == True for flag in perturbations], ['WT'] + list(perturbations.values()), ''), index = exps.index)
+    value = pd.Series('', index = exps.index)
+    for var in perturbations.values():
+        value = value.where(kind != var, lower(exps[var]))
+    exp_keys = pd.DataFrame({'row': exps['row'],
+                             'project_id': exps['project_id'],
+                             'kind': kind,
+                             'value': value,
+                             'time_point': exps['time_point'].where(exps['time_series'] == True)})
+
+    # every control can match on WT (if unperturbed) and on each of its perturbation variables
+    controls = df[is_control]
+    unperturbed = pd.concat([controls[flag] == False for flag in perturbations], axis = 1).all(axis = 1)
+    control_keys = [controls[unperturbed][['row','project_id','time_point','sample']].assign(kind = 'WT', value = '')]
+    for var in perturbations.values():
+        control_keys.append(controls[['row','project_id','time_point','sample']].assign(kind = var, value = lower(controls[var])))
+    control_keys = pd.concat(control_keys).dropna(subset = ['value']).rename(columns = {'row': 'control_row', 'sample': 'control'})
+
+    keys = ['project_id','kind','value']
+    # time series experiments without a time point stay in the time series merge, where they match nothing
+    series = exps['time_series'] == True
+    matches = pd.concat([exp_keys[~series].drop(columns = 'time_point').merge(control_keys.drop(columns = 'time_point'), on = keys),
+                         exp_keys[series].merge(control_keys.dropna(subset = ['time_point']), on = keys + ['time_point'])])
+    first = matches.sort_values('control_row').drop_duplicates(subset = 'row', keep = 'first').set_index('row')['control']
+
+    control = pd.Series(np.nan, index = df.index, dtype = object)
+    control[~is_control] = 'None'
+    control[first.index] = first
+    annotated['control'] = control.to_numpy()
+
+    return annotated
+
+def finalize(outdf, validate = True, tag = True):
+    """
+    flag inconsistent annotations and build sample tags/controls
+    `warning` holds the per experiment checks, the cross-experiment checks of validate.project_checks get their own columns
+    """
+    with metrics.stage('tag'):
+        if validate:
+            outdf = bool_check(outdf)
+            outdf = project_checks(outdf)
+            if 'replicate_conflict' in outdf:
+                outdf['warning'] = outdf['warning'] | (outdf['replicate_conflict'] == True)
+
+        if tag:
+           outdf = tagExps(outdf) 
+           outdf = setControl(outdf)
+
+    return outdf
+
+def read_output(path):
+    """
+    read an annotation table written by write_output (or a shard part), a .parquet name reads parquet
+    """
+    if path.endswith('.parquet'):
+        from llomics.columnar import read_table
+        return read_table(path)
+    try:
+        # empty annotation fields are '' in memory, keep them that way
+        return pd.read_csv(path, keep_default_na = False)
+    except pd.errors.EmptyDataError:
+        # written from an empty table, eg. a shard without projects
+        return pd.DataFrame()
+
+def write_output(outdf, outFile, tag = True):
+    """
+    write the sample table to `outFile` and the full annotation table next to it as <outFile>_FULL,
+    a .parquet name writes parquet (see columnar.write_table)
+    """
+    basename = outFile.split('.')[0]
+    if tag:
+        columns = ['project_id','experiment_id','exp_title','perturbation','sample','control','warning']
+    else:
+        columns = ['project_id','experiment_id','exp_title','perturbation','sample']
+    if outFile.endswith('.parquet'):
+        from llomics.columnar import write_table
+        write_table(outdf, f'{basename}_FULL.parquet')
+        write_table(outdf[columns], outFile)
+    else:
+        outdf.to_csv(f'{basename}_FULL.csv', index = False, sep = ',')
+        outdf[columns].to_csv(outFile, index = False, sep = ',')
@@ -1,9 +1,343 @@
 import llomics
 import json
+import random
 import pandas as pd
 
 
 model = 'gpt-4o-mini'
 
+# reference row-loop implementations of bool_check and tagExps, the vectorized versions must match them
+
+def bool_check_loop(df):
+    var_dict = {'mutation':'gene_mutation',
+                'deletion':'gene_deletion',
+                'depletion':'protein_depletion',
+                'stress':'stress_condition',
+                'time_point':'time_series'}
+
+    check = []
+    for i in range(len(df)):
+        mismatch = False
+        for var in var_dict:
+
+            if df.loc[i, var_dict[var]] == False and pd.isnull(df.loc[i, var]) == False:
+                mismatch = True
+            elif df.loc[i, var_dict[var]] == True and pd.isnull(df.loc[i, var]) == True:
+                mismatch = True
+
+        if mismatch:
+            check.append(True)
+        else:
+            check.append(False)
+    df['warning'] = check
+
+    return df
+
+def tagExps_loop(annotated_exps):
+
+    for row in range(len(annotated_exps)):
+        timepoint = str(annotated_exps.loc[row,'time_point']).replace(' ','_')
+
+        if annotated_exps.loc[row,'chip_input'] == True:
+            target = 'Input'
+        else:
+            target = annotated_exps.loc[row,'chip_target']
+
+        if any(annotated_exps.loc[row,'gene_mutation':'stress_condition']):
+            if annotated_exps.loc[row,'gene_mutation']:
+                pertype = 'gene_mutation'
+                per = annotated_exps.loc[row,'mutation']
+            elif annotated_exps.loc[row,'gene_deletion']:
+                pertype = 'gene_deletion'
+                per = annotated_exps.loc[row,'deletion']
+            elif annotated_exps.loc[row,'protein_depletion']:
+                pertype = 'protein_depletion'
+                per = annotated_exps.loc[row,'depletion']
+            elif annotated_exps.loc[row,'stress_condition']:
+                pertype = 'stress_condition'
+                per = annotated_exps.loc[row,'stress']
+
+            if annotated_exps.loc[row,'time_series']:
+                annotated_exps.loc[row,'sample'] = f'{target}-{per}-{pertype}-{timepoint}'
+            else:
+                annotated_exps.loc[row,'sample'] = f'{target}-{per}-{pertype}'
+
+            annotated_exps.loc[row,'perturbation'] = f'{pertype}'
+
+        else:
+            if annotated_exps.loc[row,'time_series']:
+                annotated_exps.loc[row,'sample'] = f'{target}-WT-{timepoint}'
+            else:
+                annotated_exps.loc[row,'sample'] = f'{target}-WT'
+
+            annotated_exps.loc[row,'perturbation'] = 'none'
+
+    return annotated_exps
+
+def setControl_loop(annotated_proj):
+    # per project row loop, as setControl was before it worked on the whole table
+    controls = pd.DataFrame()
+    exps = pd.DataFrame()
+    if not any(annotated_proj['chip_input']):
+        if any(annotated_proj['antibody_control']):
+            controls = annotated_proj[annotated_proj['antibody_control'] == True]
+            exps = annotated_proj[annotated_proj['antibody_control'] == False]
+    else:
+        controls = annotated_proj[annotated_proj['chip_input'] == True]
+        exps = annotated_proj[annotated_proj['chip_input'] == False]
+
+    for index, row in exps.iterrows():
+        if 'WT' in row['sample']:
+            if row['time_series']:
+                ctrl = controls.loc[(controls['gene_mutation'] == False) & (controls['gene_deletion'] == False) & (controls['protein_depletion'] == False) & (controls['stress_condition'] == False) & (controls['time_point'] == row['time_point']), 'sample']
+            else:
+                ctrl = controls.loc[(controls['gene_mutation'] == False) & (controls['gene_deletion'] == False) & (controls['protein_depletion'] == False) & (controls['stress_condition'] == False), 'sample']
+        else:
+            if row['gene_mutation']:
+                pertype = 'mutation'
+            elif row['gene_deletion']:
+                pertype = 'deletion'
+            elif row['protein_depletion']:
+                pertype = 'depletion'
+            elif row['stress_condition']:
+                pertype = 'stress'
+
+            if row['time_series']:
+                ctrl = controls[(controls[pertype].str.lower() == row[pertype].lower()) & (controls['time_point'] == row['time_point'])]['sample']
+            else:
+                ctrl = controls[(controls[pertype].str.lower() == row[pertype].lower())]['sample']
+
+        if not ctrl.empty:
+            exps.loc[index, 'control'] = ctrl.iloc[0]
+        else:
+            exps.loc[index, 'control'] = 'None'
+
+    return pd.concat([exps, controls])
+
+def random_annotations(n = 500, seed = 0):
+    # mix of consistent, inconsistent and missing (as read back from csv) annotations
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        row = {'experiment_id': f'SRX{i}', 'exp_title': f'exp {i}'}
+        for flag in ['gene_mutation','gene_deletion','protein_depletion','stress_condition','time_series','chip_input','antibody_control']:
+            row[flag] = rng.random() < 0.3
+        row['chip_target'] = rng.choice(['H3K4me3', 'Set1', '', None])
+        for var in ['mutation','deletion','depletion','stress','time_point']:
+            row[var] = rng.choice([f'{var} {i}', '', None])
+        rows.append(row)
+    df = pd.DataFrame(rows)
+    df['project_id'] = [f'PRJ{i % 7}' for i in range(n)]
+    return df
+
+def test_bool_check_equivalence():
+    df = random_annotations()
+    expected = bool_check_loop(df.copy())
+    result = llomics.bool_check(df.copy())
+    pd.testing.assert_frame_equal(result, expected, check_dtype = False)
+
+def test_tagExps_equivalence():
+    df = random_annotations()
+    expected = tagExps_loop(df.copy())
+    result = llomics.tagExps(df.copy())
+    pd.testing.assert_frame_equal(result, expected, check_dtype = False)
+
+def control_annotations(n = 400, seed = 0):
+    # annotations as read back from a default pd.read_csv, depletion is never used so the column is all NaN
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        row = {'project_id': f'PRJ{i % 9}', 'experiment_id': f'SRX{i}', 'exp_title': f'exp {i}', 'chip_target': rng.choice(['H3K4me3', 'Set1'])}
+        for flag in ['gene_mutation','gene_deletion','stress_condition','time_series','chip_input','antibody_control']:
+            row[flag] = rng.random() < 0.3
+        row['protein_depletion'] = False
+        row['mutation'] = rng.choice(['H3-K4R', 'h3-k4r', 'H3-K36R'])
+        row['deletion'] = rng.choice(['Δset2', 'ΔSET2', 'Δdot1'])
+        row['stress'] = rng.choice(['heat shock', 'Heat Shock', 'rapamycin'])
+        row['time_point'] = rng.choice(['0 min', '30 min'])
+        rows.append(row)
+    df = pd.DataFrame(rows)
+    df['depletion'] = float('nan')
+    # time series experiments with no time point match no control
+    df.loc[df.index % 17 == 0, ['time_series', 'time_point']] = [True, float('nan')]
+    return llomics.tagExps(df)
+
+def test_setControl_equivalence():
+    df = control_annotations()
+    result = llomics.setControl(df.copy()).set_index('experiment_id')['control']
+    for project, group in df.groupby('project_id'):
+        expected = setControl_loop(group.copy())
+        if 'control' not in expected:
+            # projects without controls were dropped, they are kept with control 'None' now
+            assert (result[group['experiment_id']] == 'None').all()
+            continue
+        expected = expected.set_index('experiment_id')['control']
+        pd.testing.assert_series_equal(result[expected.index], expected, check_names = False, check_dtype = False)
+
+def test_project_checks():
+    df = random_annotations(n = 12)
+    df[['gene_mutation','gene_deletion','protein_depletion','stress_condition','time_series','chip_input','antibody_control']] = False
+    df[['mutation','depletion','stress','time_point']] = ''
+    df['project_id'] = 'PRJ0'
+    df['chip_target'] = 'H3K4me3'
+    df['gene_deletion'] = True
+    df['deletion'] = ['Δset2'] * 10 + ['set2-delta', 'Δset2']
+    df.loc[11, 'exp_title'] = 'WT_H3K4me3_rep1'
+    df.loc[0, 'exp_title'] = 'wce'
+    result = llomics.project_checks(df.copy())
+    assert result['string_flag'].tolist() == [False] * 10 + [True, False]
+    assert result['title_flag'].tolist() == [True] + [False] * 10 + [True]
+    assert not result['balance_flag'].any()
+    assert result['title_project'].all()
+
+def test_annotate_offline_store(tmp_path, monkeypatch):
+    # projects are read from the store by the fetch threads of annotate_iter
+    import importlib
+    from llomics.store import MetaStore
+    from llomics.mock import synthetic_xml, MockClient
+    annotate = importlib.import_module('llomics.annotate')
+    monkeypatch.setenv('OPENAI_API_KEY', 'mock')
+    monkeypatch.setattr(annotate, 'client', MockClient())
+    store = MetaStore(str(tmp_path / 'store.sqlite'))
+    store.add(synthetic_xml(n_projects = 2, n_experiments = 5))
+    store.close()
+    result = annotate.annotate(['PRJNA900000', 'PRJNA900001'], model, store = str(tmp_path / 'store.sqlite'), offline = True, fetch_workers = 2)
+    assert len(result) == 10
+    assert result['project_id'].tolist() == ['PRJNA900000'] * 5 + ['PRJNA900001'] * 5
+    assert result.index.tolist() == list(range(10))
+
+def test_checkpoint_partial_line(tmp_path):
+    # a crash mid-write leaves a torn last line, the next record must not be appended onto it
+    from llomics.checkpoint import Checkpoint
+    from llomics.annotate import experiment_model
+    def annotation(experiment_id):
+        return experiment_model(experiment_id = experiment_id, exp_title = '', gene_mutation = False, gene_deletion = False,
+                                protein_depletion = False, stress_condition = False, time_series = False, chip_input = True,
+                                antibody_control = False, chip_target = 'None', mutation = '', deletion = '', depletion = '', stress = '', time_point = '')
+    path = str(tmp_path / 'checkpoint.jsonl')
+    with Checkpoint(path) as checkpoint:
+        checkpoint.add_experiment('PRJ0', model, annotation('SRX1'))
+    with open(path, 'a', encoding = 'utf-8') as log:
+        log.write('{"type": "experiment", "project_id": "PRJ0", "mod')
+    with Checkpoint(path) as checkpoint:
+        assert list(checkpoint.done('PRJ0')) == ['SRX1']
+        checkpoint.add_experiment('PRJ0', model, annotation('SRX2'))
+    with Checkpoint(path) as checkpoint:
+        assert sorted(checkpoint.done('PRJ0')) == ['SRX1', 'SRX2']
+
+def synthetic_meta(n_projects = 1, n_experiments = 12):
+    # fetch-format metadata table of mock.synthetic_xml projects
+    import io
+    from llomics.mock import synthetic_xml
+    from llomics.fetch import iter_packages, parse_package, records_frame
+    records = (parse_package(element) for element in iter_packages(io.BytesIO(synthetic_xml(n_projects, n_experiments))))
+    return records_frame(record for record in records if record is not None)
+
+def test_batch_round_trip(tmp_path):
+    from llomics import batch
+    from llomics.mock import batch_results
+    meta = synthetic_meta()
+    batch.export_summaries(meta, model, str(tmp_path / 'summaries.jsonl'))
+    batch_results(str(tmp_path / 'summaries.jsonl'), str(tmp_path / 'summaries_out.jsonl'))
+    summaries = batch.read_summaries(str(tmp_path / 'summaries_out.jsonl'))
+    assert list(summaries) == ['PRJNA900000']
+
+    batch.export_annotations(meta, model, summaries, str(tmp_path / 'experiments.jsonl'), batch_size = 4)
+    batch_results(str(tmp_path / 'experiments.jsonl'), str(tmp_path / 'experiments_out.jsonl'))
+    # drop the first experiment from the first batched result
+    lines = (tmp_path / 'experiments_out.jsonl').read_text(encoding = 'utf-8').splitlines()
+    result = json.loads(lines[0])
+    call = result['response']['body']['choices'][0]['message']['function_call']
+    arguments = json.loads(call['arguments'])
+    dropped = arguments['experimentMeta'].pop(0)['experiment_id']
+    call['arguments'] = json.dumps(arguments)
+    lines[0] = json.dumps(result)
+    (tmp_path / 'experiments_out.jsonl').write_text('\n'.join(lines) + '\n', encoding = 'utf-8')
+
+    df = batch.read_annotations(str(tmp_path / 'experiments_out.jsonl'), ids = str(tmp_path / 'experiments_ids.json'))
+    assert len(df) == 11
+    assert df.attrs['missing'] == [dropped]
+    assert set(df['experiment_id']) == set(meta['experiment_id']) - {dropped}
+
+    batch.export_annotations(meta, model, summaries, str(tmp_path / 'retry.jsonl'), experiments = df.attrs['missing'])
+    assert list(json.loads((tmp_path / 'retry_ids.json').read_text()).values()) == [[dropped]]
+
 if __name__ == '__main__':
     llomics.annotate('PRJNA262623', model)
+
+def test_batch_reply_missing_duplicate(monkeypatch):
+    # a batch reply that drops one experiment and repeats another is re-split until every experiment is annotated once
+    import importlib
+    from llomics import mock
+    annotate = importlib.import_module('llomics.annotate')
+    monkeypatch.setenv('OPENAI_API_KEY', 'mock')
+    monkeypatch.setattr(annotate, 'client', mock.MockClient())
+    mock_response = mock.mock_response
+    def faulty_response(request):
+        response = mock_response(request)
+        call = response['choices'][0]['message'].get('function_call')
+        if call is not None and call['name'] != 'json_output':
+            arguments = json.loads(call['arguments'])
+            experiments = arguments['experimentMeta']
+            if len(experiments) > 1:
+                arguments['experimentMeta'] = [experiments[0]] + experiments[:-1]
+                for choice in response['choices']:
+                    choice['message']['function_call']['arguments'] = json.dumps(arguments)
+        return response
+    monkeypatch.setattr(mock, 'mock_response', faulty_response)
+
+    expMeta = annotate.exp_columns(synthetic_meta(n_experiments = 7))
+    single = annotate.sampleExps(model, expMeta, 'summary', 1)
+    batched = annotate.sampleExps(model, expMeta, 'summary', 1, batch_size = 4)
+    assert [exp.experiment_id for exp in batched] == list(expMeta['experiment_id'])
+    assert [exp.model_dump() for exp in batched] == [exp.model_dump() for exp in single]
+
+def test_rules_classify():
+    from llomics.rules import classify
+    assert classify('SRX1', 'Input', 'strain : BY4741')['chip_input']
+    assert classify('SRX2', 'IgG rep2', '')['antibody_control']
+    assert classify('SRX3', 'WT H3K4me3 rep1', [('treatment', 'none'), ('time', 'none')])['chip_target'] == 'H3K4me3'
+    # unknown tokens, a perturbation anywhere in an attribute value or two targets go to the LLM
+    assert classify('SRX4', 'set2Δ H3K4me3', '') is None
+    assert classify('SRX5', 'WT H3K4me3 rep1', 'time : 30 min') is None
+    assert classify('SRX6', 'WT H3K4me3 rep1', [('genotype', 'wild type set2Δ')]) is None
+    assert classify('SRX7', 'WT H3K4me3 rep1', 'genotype : wild type set2Δ') is None
+    assert classify('SRX8', 'Input H3K4me3', '') is None
+    assert classify('SRX9', 'WT H3K4me3', [('genotype', 'wild type')]) is not None
+
+def test_replicate_groups():
+    from llomics.replicates import replicate_groups, fan_out
+    from llomics.annotate import experiment_model
+    expMeta = pd.DataFrame({'experiment_id': ['SRX1', 'SRX2', 'SRX3', 'SRX4', 'SRX5'],
+                            'title': ['WT H3K4me3 rep1', 'WT H3K4me3 rep2', 'WT Input Rep_1', 'WT Input', 'WT Input'],
+                            'attributes': ['replicate : 1', 'replicate : 2', 'time : none', 'time : none', 'time : 30 min']})
+    groups, conflicts = replicate_groups(expMeta)
+    assert groups == {'SRX1': ['SRX1', 'SRX2'], 'SRX3': ['SRX3', 'SRX4'], 'SRX5': ['SRX5']}
+    assert conflicts == {'SRX3', 'SRX4', 'SRX5'}
+
+    annotation = experiment_model(experiment_id = 'SRX1', exp_title = 'WT H3K4me3 rep1', gene_mutation = False, gene_deletion = False,
+                                  protein_depletion = False, stress_condition = False, time_series = False, chip_input = False,
+                                  antibody_control = False, chip_target = 'H3K4me3', mutation = '', deletion = '', depletion = '', stress = '', time_point = '')
+    copies = fan_out(annotation, groups['SRX1'], expMeta.set_index('experiment_id')['title'])
+    assert [(copy.experiment_id, copy.exp_title, copy.chip_target) for copy in copies.values()] == [('SRX1', 'WT H3K4me3 rep1', 'H3K4me3'), ('SRX2', 'WT H3K4me3 rep2', 'H3K4me3')]
+
+def test_shard_merge(tmp_path):
+    import pytest
+    from llomics import shard
+    projects = [f'PRJNA{900000 + i}' for i in range(20)]
+    # sha1 of the id, the same on every machine and python process
+    assert [shard.shard_of(project, 4) for project in projects[:5]] == [2, 1, 3, 1, 0]
+    shards = [shard.shard(projects, index, 4) for index in range(4)]
+    assert sorted(project for part in shards for project in part) == projects
+    assert shard.shard(list(reversed(projects)), 1, 4) == list(reversed(shards[1]))
+
+    for index, part in enumerate(shards[:3]):
+        shard.write_part(pd.DataFrame({'project_id': part, 'experiment_id': [f'SRX{project[5:]}' for project in part], 'chip_target': ''}),
+                         shard.part_path(str(tmp_path), index, 4))
+    with pytest.raises(ValueError, match = 'missing'):
+        shard.find_parts(str(tmp_path))
+
+    shard.write_part(pd.DataFrame(), shard.part_path(str(tmp_path), 3, 4))
+    merged = shard.merge(str(tmp_path), validate = False, tag = False, manifest = projects)
+    assert merged['project_id'].tolist() == [project for project in projects if project not in shards[3]]
+    assert (merged['chip_target'] == '').all()
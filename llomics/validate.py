@@ -5,58 +5,181 @@
 # - disagreement within a set of experiments, ie. one experiment is marked as gene_mutation but none of the rest are
 # - regular expression check, look for keys like WT, wild type etc. and flag if they are marked incorrectly
 # - disagreement between general perturb and wt variables, and speicific sub variables
+# the checks between experiments (consistency, balance, string, title) run on the whole annotation table at once,
+# grouped by project_id, each adds a per row <check>_flag and a per project <check>_project column (see project_checks)
+import re
+import numpy as np
 import pandas as pd
 
-def bool_check(df):
+# character variable that goes with each boolean variable
+var_dict = {'mutation':'gene_mutation',
+            'deletion':'gene_deletion',
+            'depletion':'protein_depletion',
+            'stress':'stress_condition',
+            'time_point':'time_series'}
+
+# keywords that identify an experiment from a single title token
+title_patterns = {'wt': re.compile(r'(wt|wild-?type|by474[12]|w303)', re.I),
+                  'input': re.compile(r'(input|inp|wce)', re.I),
+                  'igg': re.compile(r'(igg|rabbit-?igg|mouse-?igg|no-?ab)', re.I),
+                  'histone': re.compile(r'(h2a|h2b|h3|h4)(k\d+)(me[123]|ac|ub)', re.I),
+                  'replicate': re.compile(r'(rep|r|replicate|biorep)-?\d{1,2}', re.I),
+                  'chip': re.compile(r'(chip|chip-?seq)', re.I)}
+
+def title_tokens(title):
+    """
+    lower case words of an experiment title, split on whitespace and punctuation
+    """
+    return [token for token in re.split(r'[\s_,;:/()\[\]]+', str(title).lower()) if token]
+
+def bool_check(df, blank = False):
     """
     Check for inconsistencies between boolean and character variables
+    With `blank` empty strings count as missing values.
     """
-    var_dict = {'mutation':'gene_mutation',
-                'deletion':'gene_deletion',
-                'depletion':'protein_depletion',
-                'stress':'stress_condition',
-                'time_point':'time_series'}
-
-    # loop through the rows and check for inconsistencies
-    check = []
-    # for each row in the df, check if any of the bool and char variables disagree
-    for i in range(len(df)):
-        mismatch = False 
-        for var in var_dict:
-
-            if df.loc[i, var_dict[var]] == False and pd.isnull(df.loc[i, var]) == False:
-                mismatch = True 
-            elif df.loc[i, var_dict[var]] == True and pd.isnull(df.loc[i, var]) == True:
-                mismatch = True
-
-        if mismatch:
-            check.append(True)
-        else:
-            check.append(False)
+    # column-wise, a row is flagged if any of the bool and char variables disagree
+    check = pd.Series(False, index = df.index)
+    for var in var_dict:
+        values = df[var].mask(df[var].astype(str).str.strip() == '') if blank else df[var]
+        check |= ((df[var_dict[var]] == False) & values.notna()) | ((df[var_dict[var]] == True) & values.isna())
     df['warning'] = check
 
     return df
 
+# boolean perturbation variables, in the order of var_dict
+flags = list(var_dict.values())
+
+def project_flag(df, flag):
+    """
+    True for every row of a project with at least one flagged row
+    """
+    return flag.groupby(df['project_id']).transform('any')
+
+def consistency_check(df, min_size = 4):
+    """
+    Flag experiments that disagree with the rest of their project:
+    the only experiment of a project (with at least `min_size` experiments) with a boolean variable True, or the only one with it False,
+    and experiments that are neither a control nor have a chip_target.
+    """
+    project = df['project_id']
+    size = project.map(project.value_counts())
+    check = pd.Series(False, index = df.index)
+    for var in flags:
+        trues = (df[var] == True).groupby(project).transform('sum')
+        check |= (size >= min_size) & (((df[var] == True) & (trues == 1)) | ((df[var] != True) & (trues == size - 1)))
+
+    control = (df['chip_input'] == True) | (df['antibody_control'] == True)
+    check |= ~control & df['chip_target'].fillna('').astype(str).str.strip().isin(['', 'None'])
+    df['consistency_flag'] = check
+    df['consistency_project'] = project_flag(df, check)
+
+    return df
+
+def balance_table(df, balance = 0.3):
+    """
+    per project (rows) and boolean variable (columns), True if one of True/False is rare:
+    present, but at most `balance` times as common as the other
+    """
+    trues = (df[flags] == True).groupby(df['project_id']).sum()
+    falses = (df[flags] != True).groupby(df['project_id']).sum()
+    minority = trues.where(trues < falses, falses)
+    majority = trues.where(trues >= falses, falses)
+    return (minority > 0) & (minority <= balance * majority)
+
 def balance_check(df, balance = 0.3):
     """
-    Check if true false counts are dramatically imbalanced for each variable.
+    Check if true false counts are dramatically imbalanced for each variable, within each project.
     ie. if there are only one or two rows that are marked as gene_mutation, this could be an error
+    Rows on the rare side of an imbalanced variable get `balance_flag`, see balance_table for the per project table.
+    """
+    project = df['project_id']
+    check = pd.Series(False, index = df.index)
+    for var in flags:
+        value = df[var] == True
+        trues = value.groupby(project).transform('sum')
+        falses = (~value).groupby(project).transform('sum')
+        minority = trues.where(value, falses)
+        majority = falses.where(value, trues)
+        check |= (minority < majority) & (minority <= balance * majority)
+    df['balance_flag'] = check
+    df['balance_project'] = project_flag(df, check)
+
+    return df
+
+def spelling(values):
     """
-    vars = ['gene_mutation','gene_deletion','protein_depletion','stress_condition','time_series']
-    check_dict = {} 
-    for var in vars:
-        true_count = df[var].count(True)
-        false_count = df[var].count(False)
-        ratio = true_count / false_count
-        if ratio <= balance or 1/ratio <= balance:
-            check_dict[var] = True
-        else:
-            check_dict[var] = False
+    perturbation strings reduced to compare spellings, eg. 'Δset2', 'set2Δ', 'set2-delta' -> 'set2'
+    """
+    return values.str.lower().str.replace(r'delta|[\sΔδ_\-]', '', regex = True)
+
+def string_check(df):
+    """
+    Flag perturbation and time point strings that name the same thing differently within a project,
+    rows that don't use the most common spelling of their project get `string_flag`
+    """
+    check = np.zeros(len(df), dtype = bool)
+    for var in var_dict:
+        raw = df[var].fillna('').astype(str).str.strip().to_numpy()
+        values = pd.DataFrame({'project_id': df['project_id'].to_numpy(), 'key': spelling(pd.Series(raw)).to_numpy(), 'raw': raw})
+        values = values[values['key'] != '']
+        # most common spelling of each (project, key), ties go to the first seen
+        counts = values.groupby(['project_id','key','raw'], sort = False).size().rename('n').reset_index()
+        common = counts.sort_values('n', ascending = False, kind = 'stable').drop_duplicates(subset = ['project_id','key'])
+        common = values.reset_index().merge(common.drop(columns = 'n').rename(columns = {'raw': 'common'}), on = ['project_id','key'])
+        check[common['index'].to_numpy()] |= (common['raw'] != common['common']).to_numpy()
+    df['string_flag'] = check
+    df['string_project'] = project_flag(df, df['string_flag'])
+
+    return df
+
+# title_patterns matching a whole word anywhere in a title, groups made non-capturing for str.contains
+title_keywords = {name: re.compile('(?<![a-z0-9])' + re.sub(r'\((?!\?)', '(?:', pattern.pattern) + '(?![a-z0-9])', re.I)
+                  for name, pattern in title_patterns.items()}
+
+def keyword(titles, name):
+    """
+    titles with a word matching title_patterns[name]
+    """
+    return titles.str.contains(title_keywords[name], regex = True)
+
+def title_check(df):
+    """
+    Check for regular expression matches in the variables:
+    WT/wild-type titles marked as a gene mutation or deletion, and input or IgG titles that are not marked as a control
+    """
+    titles = df['exp_title'].fillna('').astype(str)
+    genetic = (df['gene_mutation'] == True) | (df['gene_deletion'] == True)
+    check = (keyword(titles, 'wt') & genetic) | \
+            (keyword(titles, 'input') & (df['chip_input'] != True)) | \
+            (keyword(titles, 'igg') & (df['antibody_control'] != True))
+    df['title_flag'] = check
+    df['title_project'] = project_flag(df, check)
+
+    return df
 
-    balance_df = pd.dataframfrom_dict(check_dict, index = [0]) 
-    return balance_df    
+def project_checks(df, balance = 0.3):
+    """
+    Run every cross-experiment check on an annotation table (all projects at once).
+    Each check adds a per row `<check>_flag` and a per project `<check>_project` column.
+    """
+    df = consistency_check(df)
+    df = balance_check(df, balance)
+    df = string_check(df)
+    df = title_check(df)
+
+    return df
+
+def project_report(df):
+    """
+    number of flagged rows per project for each check, from a table that went through project_checks
+    """
+    columns = [column for column in df if column.endswith('_flag')]
+    return df[columns].groupby(df['project_id']).sum()
 
-#def title_check(df):
+def cascade_check(df):
     """
-    Check for regular expression matches in the variables
+    rows that should be re-annotated by a stronger model:
+    bool_check (with empty strings as missing), consistency_check, string_check or title_check flags
     """
+    checked = title_check(string_check(consistency_check(bool_check(df.copy(), blank = True))))
+    return checked['warning'] | checked['consistency_flag'] | checked['string_flag'] | checked['title_flag']
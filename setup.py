@@ -12,6 +12,12 @@ setup(
         'biopython',
         'pydantic'
         ],
+    extras_require={
+        'parquet': ['pyarrow'],
+    },
+    entry_points={
+        'console_scripts': ['llomics=llomics.cli:main'],
+    },
     classifiers=[
         'License :: OSI Approved :: MIT License',  
         'Programming Language :: Python :: 3', 